@@ -1,20 +1,74 @@
 from fastapi import FastAPI, Request, Form, WebSocket, WebSocketDisconnect, HTTPException
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, PlainTextResponse
 from pydantic import BaseModel
+from typing import Literal
+import logging
 import os
 from dotenv import load_dotenv
-from utils import (query_response_from_tikapi, download_video_from_response, describe_video,
-                   create_bigquery_table, write_summary_to_bq, final_summary, grab_summaries_from_bq)
+from utils import (query_response_from_tikapi, download_video, describe_video, DESCRIBE_MODEL,
+                   cached_final_summary, FINAL_SUMMARY_MODEL)
+from clients import ClientRegistry
+from cache import SummaryCache, FinalSummaryCache, EvaluationCache
+from storage import SummarySink, SummaryWriteError, open_summary_store, check_keyword
+from pipeline import Stage, SkipItem, run_pipeline, stage_workers
+from summarize import partial_summary_fields, parse_summary_json
+from evaluation import evaluate_summary as evaluate, EvaluationError
+from video_store import VideoStore, VideoTooLargeError
+from preprocess import MODES as PREPROCESS_MODES, stats as preprocess_stats, cache_variant, effective_mode
+from jobs import JobManager, QueueFullError, current_job
+import metrics
+from metrics import RequestTiming, current_timing, span
 from tqdm import tqdm
 from jinja2 import Environment, FileSystemLoader
 import asyncio
-from google import genai
 import json
+from contextlib import asynccontextmanager
 
 # Load environment variables
 load_dotenv("test.env")  # Or the appropriate path to your .env file
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger("app")
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app):
+    # API clients are shared by all requests. Summary rows are batched into the store selected by
+    # SUMMARY_STORE, BigQuery by default; its client is only created once it is first used.
+    app.state.clients = ClientRegistry()
+    app.state.summary_store = open_summary_store(lambda: app.state.clients.bigquery)
+    app.state.summary_sink = SummarySink(app.state.summary_store)
+    # Downloaded videos are shared across keywords and kept within a disk budget
+    app.state.video_store = VideoStore(session=app.state.clients.http)
+    # Summaries submitted through /jobs run in the background on a small worker pool
+    app.state.jobs = JobManager(run_summary_job, workers=int(os.environ.get("JOB_WORKERS", 2)),
+                                max_queued=int(os.environ.get("JOB_QUEUE_SIZE", 20)))
+    app.state.jobs.start()
+    yield
+    await app.state.jobs.stop()
+    try:
+        await asyncio.to_thread(app.state.summary_sink.close)
+    except SummaryWriteError as e:
+        logger.error("Summaries lost on shutdown: %s", e)
+    app.state.summary_store.close()
+    app.state.clients.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.middleware("http")
+async def time_requests(request: Request, call_next):
+    """Collect the stage timings of every request, returned in a Server-Timing header and logged"""
+    timing = RequestTiming()
+    token = current_timing.set(timing)
+    try:
+        response = await call_next(request)
+    finally:
+        current_timing.reset(token)
+    if timing.stages:
+        response.headers["Server-Timing"] = timing.server_timing()
+        logger.info("%s %s timing %s", request.method, request.url.path, json.dumps(timing.as_dict()))
+    return response
 
 # Set up Jinja2 template directory
 templates = Environment(loader=FileSystemLoader("templates"))
@@ -22,10 +76,18 @@ templates = Environment(loader=FileSystemLoader("templates"))
 # Store active WebSocket connections
 connected_clients = {}
 
+# Summaries of already described videos, shared by all requests
+summary_cache = SummaryCache()
+# Final summaries of unchanged sets of summaries, so viewing a keyword again skips the LLM
+final_summary_cache = FinalSummaryCache()
+# Evaluations of unchanged (summary, sources) pairs, so evaluating a result again is free
+evaluation_cache = EvaluationCache()
+
 class SummarizeRequest(BaseModel):
     keyword: str
     video_number: int = 40  # Default value
     skip_download: bool = False  # Add skip_download field, default to False
+    preprocess: Literal["none", "downscale", "no_audio", "frames", "keyframes"] = "none"  # See preprocess.MODES
 
 
 # Video summarization prompt
@@ -43,6 +105,19 @@ async def home(request: Request):
     template = templates.get_template("index.html")
     return HTMLResponse(content=template.render(summary=None, keyword=None, progress=None, summaries=None), status_code=200)
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """Stage latencies, model usage, transferred bytes and cache hit rates in the Prometheus text format"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """Hit/miss counters of the summary caches and usage of the local video store"""
+    return {"video_summaries": summary_cache.stats(), "final_summaries": final_summary_cache.stats(),
+            "evaluations": evaluation_cache.stats(), "videos": app.state.video_store.stats(),
+            "preprocess": preprocess_stats()}
+
 @app.websocket("/progress")
 async def websocket_endpoint(websocket: WebSocket):
     """WebSocket endpoint to send real-time progress updates"""
@@ -51,14 +126,22 @@ async def websocket_endpoint(websocket: WebSocket):
     connected_clients[client_id] = websocket
     try:
         while True:
-            await asyncio.sleep(30)  # Keep the connection alive
+            # Nothing is expected from the client, but receiving notices a disconnect right away
+            await websocket.receive_text()
     except WebSocketDisconnect:
-        del connected_clients[client_id]
+        pass
+    finally:
+        connected_clients.pop(client_id, None)
 
 async def send_progress(message: str):
-    """Send a progress update to all connected WebSocket clients"""
+    """Send a progress update to the subscribers of the running job, or else to all connected WebSocket clients"""
+    job = current_job.get()
+    if job is not None:
+        job.publish(message)
+        return
+
     disconnected_clients = []
-    for client_id, client in connected_clients.items():
+    for client_id, client in list(connected_clients.items()):
         try:
             await client.send_text(message)
         except Exception:
@@ -66,187 +149,330 @@ async def send_progress(message: str):
 
     # Remove disconnected clients
     for client_id in disconnected_clients:
-        del connected_clients[client_id]
+        connected_clients.pop(client_id, None)
 
 
 class EvaluationRequest(BaseModel):
     summary: str  # 用户的最终 summary
     small_summaries: list  # 原始的多个 small summaries
 
-def generate_prompt(summary, small_summaries):
-    """
-    生成 Prompt，提供给 GPT-4 / Claude / Gemini
-    """
-    prompt = f"""
-    You are an AI expert in evaluating text summarization accuracy. Your task is to evaluate the **Final Summary** based on the provided **Source Summaries**. 
-    
-    Here are multiple source summaries from different videos:
-    {'\n------------------------\n'.join([f"{idx+1}. "+ summary for idx, summary in enumerate(small_summaries)])}
-
-    Below is the final summary produced from these sources:
-    {summary}
-
-    ### **Evaluation Criteria**
-    1. **Sentence-Level Precision & Recall Calculation**
-       - Each sentence in the **Final Summary** should be traced back to its **original Source Summaries**.
-       - Each Source Summary is separated by a line separator.
-       - Your goal is to determine whether the references provided for each sentence in the Final Summary are correct.
-       - **Reference Format:** Each sentence should list the index of its original Source Summaries. If the sentence is a generalization that includes information from all sources, mark it as **(ALL)**.
-
-       #### **Precision Calculation**
-       - **Precision = Correct References / (Correct References + Incorrect References)**
-       - **Precision 1.0:** If all listed references are correct (i.e., no incorrect source is included).
-       - **Precision < 1.0:** If any incorrect source is included.
-       - Example: If a sentence refers to sources **[1, 3]**, but only **1** is correct and **3** is incorrect, then:
-         - Correct References = 1, Incorrect References = 1
-         - **Precision = 1 / (1+1) = 0.5**
-
-       #### **Recall Calculation**
-       - **Recall = Correct References / (Correct References + Missing References)**
-       - **Recall 1.0:** If all correct sources are included.
-       - **Recall < 1.0:** If some correct sources are missing.
-       - Example: If a sentence should refer to **[1, 2, 3]**, but only lists **[1]**, then:
-         - Correct References = 1, Missing References = 2
-         - **Recall = 1 / (1+2) = 0.33**
-
-       #### **How to Identify Mistakes**
-       - **Incorrect Sources:** If a reference includes sources that do not contain the information in the sentence.
-       - **Missing Sources:** If the sentence should include references to sources that it does not list.
-       
-    2. Missing Content Identification
-
-        Identify important content from the Source Summaries that is missing in the Final Summary.
-        A content is considered important if:
-        It appears frequently across multiple sources.
-        It contains unique or major information that is not covered in any sentence of the Final Summary.
-        Provide the missing sentence and list the sources where it appeared.
-        
-    3. Tell the reason of your judgement, as detailed as possible. 
-
-    Return ALL your response in the following structured JSON format:
-    IMPORTANT: Please make sure the output value is able to be parsed by json.loads.
-    {{
-        "precision_recall": [
-            {{
-                "text": "Final summary sentence",
-                "precision": 0.8,
-                "recall": 0.9,
-                "errors": ["Incorrect source: [1, 2]", "Missing source: [3, 4]", "Reasons: Source 1 is blablabla, source 2 is blablabla..."]
-            }}
-        ],
-        "missing_sentences": [
-            {{ "text": "Important missing sentence", "source": [2, 5]., "reasons": "Source 2 is blablabla."  }}
-        ]
-    }}
-    """
-
-    return prompt
-
 @app.post("/evaluate_summary")
 async def evaluate_summary(data: EvaluationRequest):
     """
     Call LLM to evaluate the quality of summaries
     """
     await send_progress("📊 Generating the evaluation of summaries...")
-    prompt = generate_prompt(data.summary, data.small_summaries)
-
-    client = genai.Client(api_key=os.environ["GEMINI_KEY"])
-    response = client.models.generate_content(
-        model='gemini-1.5-pro',
-        contents=[prompt]
-    )
-    evaluation_result = response.text.strip("```json").strip("```")
     try:
-        import json
-        evaluation_json = json.loads(evaluation_result)
-        print("success")
-        return evaluation_json
-    except json.JSONDecodeError:
-        print("error")
-        return {"error": "Failed to parse model response"}
-
-  
-def process_summaries_from_bq(keyword):
-    """Extract Summaries from BigQuery and get the final summary"""
-    summaries = grab_summaries_from_bq(
-        project_id=os.environ["GCP_PROJECT_ID"],
-        dataset_id=os.environ["BQ_DATASET_ID"],
-        table_id=keyword
-    )
-    if not summaries:
+        # Chunks of the sources are judged concurrently in worker threads, the event loop stays free
+        return await asyncio.to_thread(evaluate, data.summary, data.small_summaries, app.state.clients.gemini,
+                                       evaluation_cache)
+    except EvaluationError as e:
+        return {"error": str(e)}
+
+
+def process_summaries_from_bq(keyword, on_text=None):
+    """Extract Summaries from the summary store and get the final summary, streaming its last call to
+    `on_text` if given"""
+    with span("store_read"):
+        rows = [(row['filename'], row['summary'].replace('\n', ''))
+                for row in app.state.summary_store.iter_rows(keyword) if row['summary']]
+    if not rows:
         raise HTTPException(status_code=404, detail=f"No summaries found for keyword: {keyword}")
-    summaries = [summary.replace('\n', '') for summary in summaries]
-    result, prompt = final_summary(summaries, table_id=keyword)
+    # Unchanged keywords are served from the cache and new videos are merged into the previous result
+    with span("final_summary"):
+        return cached_final_summary(rows, keyword, final_summary_cache, model=FINAL_SUMMARY_MODEL,
+                                    client=app.state.clients.gemini, on_text=on_text)
+
+
+async def summarize_into_bq(videos, keyword, video_number, preprocess="none"):
+    """Download, describe and store up to `video_number` of the streamed (page, item) pairs, with the
+    three stages overlapping. Returns the stored filenames and the number of TikAPI pages used."""
+    # Summaries of preprocessed videos are cached apart from those of the original videos
+    variant = cache_variant(effective_mode(preprocess))
+    pages = 0
+
+    async def tracked():
+        nonlocal pages
+        try:
+            async for page, item in videos:
+                if page.number > pages:
+                    pages = page.number
+                    await send_progress(f"📥 Downloading batch {page.number}...")
+                yield page, item
+        finally:
+            await videos.aclose()
+
+    video_store = app.state.video_store
+
+    async def download(video):
+        page, item = video
+        filename = f"{keyword}/{item['id']}.mp4"
+        summary = await asyncio.to_thread(summary_cache.get, item['id'], PROMPT, DESCRIBE_MODEL, variant)
+        if summary is not None:
+            # Already described with the same prompt and model, skip both download and Gemini
+            return filename, None, item['id'], summary
+        try:
+            path = await asyncio.to_thread(download_video, page, item, store=video_store)
+        except VideoTooLargeError as e:
+            await send_progress(f"⏭️ Skipping video {item['id']}: {e}")
+            raise SkipItem(str(e))
+        return filename, path, item['id'], None
+
+    analyzed = 0
+
+    async def describe(downloaded):
+        nonlocal analyzed
+        filename, path, video_id, summary = downloaded
+        analyzed += 1
+        if summary is not None:
+            await send_progress(f"♻️ Reusing cached summary for video {analyzed}/{video_number}...")
+            return filename, summary
+        try:
+            await send_progress(f"📝 Analyzing video {analyzed}/{video_number}...")
+            summary, mode = await asyncio.to_thread(describe_video, path, PROMPT, DESCRIBE_MODEL,
+                                                    client=app.state.clients.gemini, preprocess=preprocess)
+        finally:
+            video_store.unpin(video_id)
+        await asyncio.to_thread(summary_cache.put, video_id, PROMPT, DESCRIBE_MODEL, summary, cache_variant(mode))
+        return filename, summary
+
+    summary_sink = app.state.summary_sink
+
+    async def store(described):
+        filename, summary = described
+        await asyncio.to_thread(summary_sink.write, keyword, filename, summary)
+        return filename
+
+    stages = [
+        Stage("download", download, workers=stage_workers("download", 4)),
+        Stage("describe", describe, workers=stage_workers("describe", 4)),
+        Stage("store", store, workers=stage_workers("store", 1), ordered=True),
+    ]
+    try:
+        filenames = await run_pipeline(tracked(), stages, limit=video_number,
+                                       queue_size=int(os.environ.get("PIPELINE_QUEUE_SIZE", 8)))
+    finally:
+        # The final summary reads the table right after, so nothing may stay buffered
+        await asyncio.to_thread(summary_sink.flush, keyword)
+    return filenames, pages
+
+
+async def collect_summaries(keyword, video_number, preprocess="none"):
+    """Fetch, describe and store new videos; a failure after TikAPI was reached falls back to past summaries"""
+    await send_progress(f"🔍 Fetching up to {video_number} videos from TikAPI...")
+    await asyncio.to_thread(app.state.summary_store.ensure_table, keyword)
+    videos = query_response_from_tikapi(keyword=keyword, video_number=video_number, api=app.state.clients.tikapi)
+    download_success = True
+    try:
+        _, total_queries = await summarize_into_bq(videos, keyword, video_number, preprocess)
+        await send_progress(f"📊 Total TikAPI queries made: {total_queries}")
+    except Exception as e:
+        await send_progress(f"❌ Error during download: {e}")
+        download_success = False
+
+    if not download_success:
+        await send_progress("✅ TikAPI download failed, retrieving past summaries from BigQuery...")
+
+
+async def stream_final_summary(keyword, job):
+    """process_summaries_from_bq, publishing every field of the final summary to the job's subscribers as it
+    is generated, as {"field", "text", "complete"} events"""
+    loop = asyncio.get_running_loop()
+    texts = asyncio.Queue()
+    work = asyncio.ensure_future(asyncio.to_thread(
+        process_summaries_from_bq, keyword, lambda text: loop.call_soon_threadsafe(texts.put_nowait, text)))
+    sent = {}
+
+    def publish(fields):
+        for field, (text, complete) in fields.items():
+            if sent.get(field) != (text, complete) and isinstance(text, str):
+                sent[field] = (text, complete)
+                job.publish(None, key=f"field:{field}", field=field, text=text, complete=complete)
+
+    try:
+        while not work.done():
+            next_text = asyncio.ensure_future(texts.get())
+            await asyncio.wait({work, next_text}, return_when=asyncio.FIRST_COMPLETED)
+            if not next_text.done():
+                next_text.cancel()
+                continue
+            text = next_text.result()
+            # Only the latest text matters when chunks arrive faster than they are sent
+            while not texts.empty():
+                text = texts.get_nowait()
+            publish(partial_summary_fields(text))
+    finally:
+        if not work.done():
+            work.cancel()
+    result, summaries, prompt = work.result()
+    # Cached results arrive without streaming, and citations may have been renumbered after the last chunk
+    publish({field: (value, True) for field, value in (parse_summary_json(result) or {}).items()})
     return result, summaries, prompt
 
 
+async def build_final_summary(keyword):
+    """Final summary of everything stored for `keyword`, as the context of the result page. Within a job, the
+    summary is streamed to its subscribers while it is generated."""
+    await send_progress("📊 Generating the final summary...")
+    job = current_job.get()
+    if job is not None and os.environ.get("FINAL_SUMMARY_STREAM", "1") != "0":
+        result, summaries, prompt = await stream_final_summary(keyword, job)
+    else:
+        result, summaries, prompt = await asyncio.to_thread(process_summaries_from_bq, keyword)
+    result = result.strip("```json").strip("```")
+    parsed = json.loads(result)
+    return dict(
+        summary=result,
+        summaries=summaries,
+        keyword=keyword,
+        prompt=prompt.replace('*', '').replace('#', ''),
+        justification=parsed.get('justification', ''),
+        exclusion=parsed.get('exclusion', '')
+    )
+
+
+def _check_keyword(keyword):
+    try:
+        return check_keyword(keyword)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/summaries/{keyword}")
+async def list_summaries(keyword: str, page_size: int = 100, page_token: str = None, since: float = None):
+    """One page of the stored video summaries of a keyword, optionally only those inserted after `since`
+    (seconds since the epoch). Pass the returned `next_page_token` to get the next page."""
+    _check_keyword(keyword)
+    rows, next_page_token = await asyncio.to_thread(app.state.summary_store.read_page, keyword,
+                                                    min(max(page_size, 1), 1000), page_token, since)
+    return {"rows": rows, "next_page_token": next_page_token}
+
+
+def render_summary(context):
+    template = templates.get_template("index.html")
+    return HTMLResponse(content=template.render(**context), status_code=200)
+
+
 @app.post("/", response_class=HTMLResponse)
 async def summarize_videos(
     request: Request,
     keyword: str = Form(...),
     video_number: int = Form(None),  # Allow None
-    skip_download: bool = Form(False)
+    skip_download: bool = Form(False),
+    preprocess: str = Form("none")
 ):
     """Process video summarization, handling skip_download and empty video_number."""
+    _check_keyword(keyword)
+    if preprocess not in PREPROCESS_MODES:
+        raise HTTPException(status_code=400, detail=f"preprocess must be one of {', '.join(PREPROCESS_MODES)}")
     if skip_download:
         await send_progress("✅ Skipping download, retrieving past summaries from BigQuery...")
     elif video_number is None:
         raise HTTPException(status_code=400, detail="video_number is required when skip_download is false")
     else:
         try:
-            await send_progress(f"🔍 Fetching up to {video_number} videos from TikAPI...")
-            response_ls = query_response_from_tikapi(keyword=keyword, video_number=video_number)
-            total_queries = len(response_ls)
-            await send_progress(f"📊 Total TikAPI queries made: {total_queries}")
-            
-            create_bigquery_table(table_id=keyword)
-            total_processed_videos = 0
-            download_success = True
-
-            for idx, response in enumerate(response_ls):
-                if total_processed_videos >= video_number:
-                    break
-                await send_progress(f"📥 Downloading batch {idx+1}...")
-                try:
-                    paths = download_video_from_response(response, directory=keyword)
-                    for path in paths:
-                        if total_processed_videos >= video_number:
-                            break
-                        await send_progress(f"📝 Analyzing video {total_processed_videos + 1}/{video_number}...")
-                        summary = describe_video(path, PROMPT)
-                        write_summary_to_bq(
-                            project_id=os.environ["GCP_PROJECT_ID"],
-                            dataset_id=os.environ["BQ_DATASET_ID"],
-                            table_id=keyword,
-                            filename=path,
-                            summary=summary
-                        )
-                        total_processed_videos += 1
-                    if total_processed_videos >= video_number:
-                        break
-                except Exception as e:
-                    await send_progress(f"❌ Error during download: {e}")
-                    download_success = False
-                    break
-
-            if not download_success:
-                await send_progress("✅ TikAPI download failed, retrieving past summaries from BigQuery...")
-
+            await collect_summaries(keyword, video_number, preprocess)
         except Exception as e:
             return HTMLResponse(content=f"<h2>Error: {str(e)}</h2>", status_code=500)
 
     try:        
-        await send_progress("📊 Generating the final summary...")
-        result, summaries, prompt = process_summaries_from_bq(keyword)
-        result = result.strip("```json").strip("```")
-        template = templates.get_template("index.html")
-        return HTMLResponse(content=template.render(
-            summary=result,
-            summaries=summaries,
-            keyword=keyword,
-            prompt=prompt.replace('*', '').replace('#', ''),
-            justification=json.loads(result).get('justification', ''),
-            exclusion=json.loads(result).get('exclusion', '')
-        ), status_code=200)
+        return render_summary(await build_final_summary(keyword))
     except Exception as e:
-        return HTMLResponse(content=f"<h2>Error: {str(e)}</h2>", status_code=500)
\ No newline at end of file
+        return HTMLResponse(content=f"<h2>Error: {str(e)}</h2>", status_code=500)
+
+
+async def run_summary_job(keyword, video_number, skip_download, preprocess):
+    """Same flow as summarize_videos, run by a job worker with progress going to the job's subscribers"""
+    timing = RequestTiming()
+    token = current_timing.set(timing)
+    try:
+        if skip_download:
+            await send_progress("✅ Skipping download, retrieving past summaries from BigQuery...")
+        else:
+            await collect_summaries(keyword, video_number, preprocess)
+        result = await build_final_summary(keyword)
+    finally:
+        current_timing.reset(token)
+        logger.info("Job for %s timing %s", keyword, json.dumps(timing.as_dict()))
+    return {**result, "timings": timing.as_dict()}
+
+
+@app.post("/jobs")
+async def submit_job(data: SummarizeRequest):
+    """Queue a summarization and return its job id right away. Identical in-flight requests share one job."""
+    _check_keyword(data.keyword)
+    try:
+        job, created = app.state.jobs.submit(keyword=data.keyword, video_number=data.video_number,
+                                             skip_download=data.skip_download, preprocess=data.preprocess)
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=f"Too many queued jobs, try again later ({e})")
+    return {"job_id": job.id, "status": job.status, "deduplicated": not created}
+
+
+def _get_job(job_id):
+    job = app.state.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job: {job_id}")
+    return job
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    """Status of a job, with its result once it has succeeded"""
+    job = _get_job(job_id)
+    return {**job.describe(), "result": job.result}
+
+
+@app.get("/jobs/{job_id}/view", response_class=HTMLResponse)
+async def job_view(job_id: str):
+    """Result page of a finished job"""
+    job = _get_job(job_id)
+    if job.status == "failed":
+        return HTMLResponse(content=f"<h2>Error: {job.error}</h2>", status_code=500)
+    if job.status != "succeeded":
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}")
+    return render_summary(job.result)
+
+
+@app.websocket("/jobs/{job_id}/progress")
+async def job_progress(websocket: WebSocket, job_id: str, after: int = 0):
+    """Progress of one job as {"seq", "message"} JSON messages.
+
+    Buffered messages after sequence number `after` are replayed first, so a reconnecting client passes the
+    last `seq` it received. A final {"status"} message is sent before the server closes the socket.
+    """
+    await websocket.accept()
+    job = app.state.jobs.get(job_id)
+    if job is None:
+        await websocket.close(code=4404)
+        return
+    backlog, queue = job.subscribe(after=after)
+    disconnected = asyncio.create_task(websocket.receive_text())
+    try:
+        for event in backlog:
+            await websocket.send_json(event)
+        while True:
+            next_event = asyncio.create_task(queue.get())
+            await asyncio.wait({next_event, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+            if disconnected.done():
+                if disconnected.exception() is not None:
+                    # The client went away
+                    next_event.cancel()
+                    return
+                # Messages from the client are ignored
+                disconnected = asyncio.create_task(websocket.receive_text())
+            if not next_event.done():
+                next_event.cancel()
+                continue
+            event = next_event.result()
+            if event is None:
+                break
+            await websocket.send_json(event)
+        # None means the job is done, or this subscriber fell behind and has to reconnect to replay
+        await websocket.send_json({"status": job.status})
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        job.unsubscribe(queue)
+        disconnected.cancel()
@@ -0,0 +1,358 @@
+"""Local stand-ins for TikAPI, Gemini and BigQuery, for benchmarks that must not spend API quota.
+
+Every call sleeps for a latency drawn around a typical value of the real service, multiplied by
+`time_scale` so a benchmark doesn't take as long as the real thing. Gemini calls fail with a retryable 503 at
+`error_rate` and with a 429 above `rpm` requests per (scaled) minute. Durations of every call are
+collected by a shared `Recorder`.
+"""
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from datetime import datetime
+from types import SimpleNamespace
+
+from google.genai import errors, types
+
+
+class Recorder:
+    """Durations of the simulated calls, by stage name"""
+
+    def __init__(self):
+        self.durations = defaultdict(list)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timed(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.durations[stage].append(time.perf_counter() - start)
+
+    def reset(self):
+        with self._lock:
+            self.durations = defaultdict(list)
+
+
+class Latency:
+    """Log-normal latencies around typical values, scaled by `time_scale`"""
+
+    def __init__(self, time_scale=0.05, seed=0):
+        self.time_scale = time_scale
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sleep(self, typical, spread=0.3):
+        with self._lock:
+            seconds = typical * self._random.lognormvariate(0, spread)
+        time.sleep(seconds * self.time_scale)
+
+    def chance(self, probability):
+        with self._lock:
+            return self._random.random() < probability
+
+
+_WORDS = ("basketball dunk crowd coach fans highlight court player interview trade season playoff "
+          "shot referee jersey locker training rookie legend replay arena music dance meme").split()
+
+
+class _SearchResponse:
+    def __init__(self, body, tikapi):
+        self._body = body
+        self._tikapi = tikapi
+
+    def json(self):
+        return self._body
+
+    def save_video(self, url, path):
+        with open(path, "wb") as video_file:
+            for chunk in self._tikapi.session.get(url).iter_content(1024 * 1024):
+                video_file.write(chunk)
+
+
+class FakeTikAPI:
+    """`api.public.search` returning pages of `page_size` videos, a share of which isn't downloadable"""
+
+    def __init__(self, latency, recorder, session, page_size=12, undownloadable=0.1, id_prefix=None):
+        self.latency = latency
+        self.recorder = recorder
+        self.session = session
+        self.page_size = page_size
+        self.undownloadable = undownloadable
+        self.id_prefix = id_prefix or uuid.uuid4().hex[:8]
+        self.public = SimpleNamespace(search=self.search)
+        self.searches = 0
+
+    def search(self, category, query, nextCursor=None):
+        with self.recorder.timed("search"):
+            self.latency.sleep(0.8)
+            self.searches += 1
+            start = int(nextCursor or 0)
+            items = []
+            for number in range(start, start + self.page_size):
+                video = {"id": f"{self.id_prefix}{number:06d}"}
+                if not self.latency.chance(self.undownloadable):
+                    video["playAddr"] = f"https://fake.tiktok/{video['id']}.mp4"
+                items.append({"video": video})
+            body = {"item_list": items, "nextCursor": start + self.page_size, "hasMore": True,
+                    "$other": {"videoLinkHeaders": {"Cookie": "tt_chain_token=fake"}}}
+            return _SearchResponse(body, self)
+
+
+class _VideoResponse:
+    def __init__(self, size, latency, recorder, bandwidth):
+        self.size = size
+        self.latency = latency
+        self.recorder = recorder
+        self.bandwidth = bandwidth
+        self.headers = {"Content-Length": str(size)}
+        self.status_code = 200
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size=1024 * 1024):
+        with self.recorder.timed("download"):
+            self.latency.sleep(0.15)
+            chunk = os.urandom(min(chunk_size, self.size))
+            for offset in range(0, self.size, chunk_size):
+                self.latency.sleep(min(chunk_size, self.size - offset) / self.bandwidth, spread=0.1)
+                yield chunk[:self.size - offset]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class FakeHTTPSession:
+    """`requests.Session.get` serving random mp4-sized bodies at `bandwidth` bytes per second"""
+
+    def __init__(self, latency, recorder, video_bytes=2 * 1024 * 1024, bandwidth=20 * 1024 * 1024):
+        self.latency = latency
+        self.recorder = recorder
+        self.video_bytes = video_bytes
+        self.bandwidth = bandwidth
+
+    def get(self, url, headers=None, stream=False, timeout=None):
+        return _VideoResponse(self.video_bytes, self.latency, self.recorder, self.bandwidth)
+
+    def close(self):
+        pass
+
+
+class _Files:
+    def __init__(self, gemini):
+        self.gemini = gemini
+
+    def upload(self, file):
+        with self.gemini.recorder.timed("upload"):
+            self.gemini.check_limits()
+            self.gemini.latency.sleep(0.2 + os.path.getsize(file) / self.gemini.upload_bandwidth)
+            # Processing is waited out here rather than polled, as the poll interval isn't scaled
+            self.gemini.latency.sleep(2.0)
+            return self.get(f"files/{uuid.uuid4().hex}")
+
+    def get(self, name):
+        return SimpleNamespace(name=name, uri=f"https://fake.gemini/{name}", mime_type="video/mp4",
+                               state=types.FileState.ACTIVE, error=None)
+
+    def delete(self, name):
+        pass
+
+
+class _Models:
+    def __init__(self, gemini):
+        self.gemini = gemini
+
+    def generate_content(self, model, contents):
+        prompt = "\n".join(part for part in contents if isinstance(part, str))
+        is_video = len(contents) > 1
+        kind = "describe" if is_video else "evaluate" if "**Final Summary**" in prompt else "final_summary"
+        with self.gemini.recorder.timed(kind):
+            self.gemini.check_limits()
+            prompt_tokens = 300 + (258 * 30 if is_video else len(prompt) // 4)
+            self.gemini.latency.sleep(4.0 if is_video else 1.0 + prompt_tokens / 20000)
+            if kind == "describe":
+                text = self.gemini.describe()
+            elif kind == "evaluate":
+                text = self.gemini.evaluate(prompt)
+            else:
+                text = self.gemini.summarize(prompt)
+            usage = types.GenerateContentResponseUsageMetadata(
+                prompt_token_count=prompt_tokens, candidates_token_count=len(text) // 4,
+                total_token_count=prompt_tokens + len(text) // 4)
+            return SimpleNamespace(text=text, usage_metadata=usage)
+
+    def generate_content_stream(self, model, contents):
+        """A text prompt's response in chunks, the first one once the prompt is processed"""
+        prompt = "\n".join(part for part in contents if isinstance(part, str))
+        with self.gemini.recorder.timed("final_summary"):
+            self.gemini.check_limits()
+            prompt_tokens = 300 + len(prompt) // 4
+            self.gemini.latency.sleep(0.3 + prompt_tokens / 20000)
+            text = self.gemini.summarize(prompt)
+            chunks = [text[start:start + 64] for start in range(0, len(text), 64)]
+            for number, chunk in enumerate(chunks, 1):
+                self.gemini.latency.sleep(0.7 / len(chunks))
+                usage = None
+                if number == len(chunks):
+                    usage = types.GenerateContentResponseUsageMetadata(
+                        prompt_token_count=prompt_tokens, candidates_token_count=len(text) // 4,
+                        total_token_count=prompt_tokens + len(text) // 4)
+                yield SimpleNamespace(text=chunk, usage_metadata=usage)
+
+    def count_tokens(self, model, contents):
+        with self.gemini.recorder.timed("count_tokens"):
+            self.gemini.latency.sleep(0.2)
+            text = contents if isinstance(contents, str) else "\n".join(map(str, contents))
+            return SimpleNamespace(total_tokens=len(text) // 4)
+
+
+class FakeGenaiClient:
+    """`genai.Client` with files.upload/get/delete and models.generate_content(_stream)/count_tokens.
+
+    Video prompts get a description made of random topic words, text prompts a final-summary JSON citing
+    the numbered descriptions found in the prompt, and evaluation prompts a judgement of every sentence.
+    """
+
+    def __init__(self, latency, recorder, rpm=2000, error_rate=0.01, upload_bandwidth=10 * 1024 * 1024):
+        self.latency = latency
+        self.recorder = recorder
+        self.rpm = rpm
+        self.error_rate = error_rate
+        self.upload_bandwidth = upload_bandwidth
+        self.files = _Files(self)
+        self.models = _Models(self)
+        self._requests = deque()
+        self._lock = threading.Lock()
+        self.rejected = 0
+
+    def check_limits(self):
+        now = time.monotonic()
+        window = 60 * self.latency.time_scale
+        with self._lock:
+            while self._requests and now - self._requests[0] > window:
+                self._requests.popleft()
+            limited = len(self._requests) >= self.rpm
+            if not limited:
+                self._requests.append(now)
+        if limited:
+            self.rejected += 1
+            raise errors.ClientError(429, {"error": {"code": 429, "message": "Resource exhausted",
+                                                     "status": "RESOURCE_EXHAUSTED"}})
+        if self.latency.chance(self.error_rate):
+            self.rejected += 1
+            raise errors.ServerError(503, {"error": {"code": 503, "message": "The model is overloaded",
+                                                     "status": "UNAVAILABLE"}})
+
+    def describe(self):
+        with self._lock:
+            words = [random.choice(_WORDS) for _ in range(120)]
+        return "The video shows " + " ".join(words) + "."
+
+    def summarize(self, prompt):
+        count = len(re.findall(r"^\d+\. ", prompt, re.M)) or 1
+        sentences = [f"Topic {index} is discussed ({index})." for index in range(1, min(count, 8) + 1)]
+        return json.dumps({"summary": " ".join(sentences + ["Fans react strongly (ALL)."]),
+                           "justification": "Each sentence cites the descriptions it is based on.",
+                           "exclusion": "None."})
+
+    def evaluate(self, prompt):
+        sources = [int(number) for number in re.findall(r"^\s*(\d+)\. ", prompt, re.M)]
+        sentences = len(re.findall(r"^\s*S\d+\. ", prompt, re.M))
+        # Sentence i is found in the sources numbered i modulo the number of sentences
+        judged = [{"sentence": index, "sources": [number for number in sources if number % sentences == index - 1],
+                   "reasons": "The sources mention the topic."} for index in range(1, sentences + 1)]
+        missing = [{"text": "Fans debate the referee decisions.", "source": sources[:2],
+                    "reasons": "Several sources mention it."}]
+        return json.dumps({"sentences": judged, "missing_sentences": missing})
+
+    def close(self):
+        pass
+
+
+class FakeBigQuery:
+    """In-memory BigQuery with the calls BigQueryStore makes"""
+
+    def __init__(self, latency, recorder):
+        self.latency = latency
+        self.recorder = recorder
+        self.tables = defaultdict(list)
+        self.schemas = {}
+        self._lock = threading.Lock()
+
+    def create_table(self, table, exists_ok=False):
+        self.latency.sleep(0.3)
+        with self._lock:
+            self.schemas.setdefault(str(table.reference), table.schema)
+        return table
+
+    def update_table(self, table, fields):
+        return table
+
+    def insert_rows_json(self, table_ref, rows, row_ids=None):
+        with self.recorder.timed("store"):
+            self.latency.sleep(0.2)
+            with self._lock:
+                existing = {row_id for row_id, _ in self.tables[table_ref]}
+                for row_id, row in zip(row_ids or [uuid.uuid4().hex for _ in rows], rows):
+                    if row_id not in existing:
+                        self.tables[table_ref].append((row_id, dict(row)))
+            return []
+
+    def list_rows(self, table, page_size=None, page_token=None, **kwargs):
+        with self.recorder.timed("read"):
+            self.latency.sleep(0.15)
+            with self._lock:
+                rows = [row for _, row in self.tables[str(table)]]
+            start = int(page_token or 0)
+            end = start + (page_size or len(rows))
+            page = [{**row, "inserted_at": datetime.fromisoformat(row["inserted_at"])
+                     if isinstance(row.get("inserted_at"), str) else None} for row in rows[start:end]]
+            return SimpleNamespace(pages=iter([page]), next_page_token=str(end) if end < len(rows) else None)
+
+    def query(self, query, job_config=None, project=None, **kwargs):
+        """Runs BigQueryStore's `inserted_at > @since` read into an anonymous table, as BigQuery does"""
+        match = re.search(r"FROM `([^`]+)` WHERE inserted_at > @since", query)
+        if match is None:
+            raise ValueError(f"FakeBigQuery can't run the query: {query}")
+        since = next(parameter.value for parameter in job_config.query_parameters if parameter.name == "since")
+        with self.recorder.timed("read"):
+            self.latency.sleep(0.5)
+            with self._lock:
+                rows = [(datetime.fromisoformat(row["inserted_at"]), row) for _, row in self.tables[match.group(1)]]
+                destination = SimpleNamespace(project=project or "fake", dataset_id="_anonymous",
+                                              table_id=uuid.uuid4().hex)
+                self.tables[f"{destination.project}.{destination.dataset_id}.{destination.table_id}"] = [
+                    (None, row) for inserted_at, row in sorted(rows, key=lambda pair: pair[0]) if inserted_at > since
+                ]
+        return SimpleNamespace(result=lambda: None, destination=destination)
+
+    def close(self):
+        pass
+
+
+def fake_registry(time_scale=0.05, seed=0, video_bytes=2 * 1024 * 1024, error_rate=0.01, rpm=2000):
+    """A ClientRegistry whose clients are all fakes, and the recorder of their calls"""
+    from clients import ClientRegistry
+
+    latency = Latency(time_scale, seed)
+    recorder = Recorder()
+    session = FakeHTTPSession(latency, recorder, video_bytes=video_bytes)
+    registry = ClientRegistry()
+    registry._clients.update(
+        gemini=FakeGenaiClient(latency, recorder, rpm=rpm, error_rate=error_rate),
+        tikapi=FakeTikAPI(latency, recorder, session),
+        bigquery=FakeBigQuery(latency, recorder),
+        http=session,
+    )
+    return registry, recorder
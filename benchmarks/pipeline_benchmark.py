@@ -0,0 +1,197 @@
+"""End-to-end benchmark of the web app, the CLI and the final summary against the fakes in benchmarks/fakes.py.
+
+Nothing leaves the machine: TikAPI, Gemini, BigQuery and the video CDN are simulated with scaled latencies,
+errors and rate limits. Every scenario runs at each video count and concurrency level and reports videos/s,
+p50/p95 latency of every stage and the peak Python memory. Pass `--baseline` with an earlier output file to
+compare against it.
+
+    python -m benchmarks.pipeline_benchmark --videos 10,40 --concurrency 1,4 --output bench.json
+    python -m benchmarks.pipeline_benchmark --baseline bench.json --max-regression 0.2
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from benchmarks.fakes import fake_registry
+
+
+def _configure_env(workdir):
+    # Caches and stores live in a throwaway directory, so every run starts cold
+    os.environ.update(
+        SUMMARY_CACHE_PATH=os.path.join(workdir, "summaries.sqlite"),
+        FINAL_SUMMARY_CACHE_PATH=os.path.join(workdir, "final_summaries.sqlite"),
+        VIDEO_STORE_PATH=os.path.join(workdir, "videos"),
+        SUMMARY_STORE="bigquery",
+        GCP_PROJECT_ID="benchmark",
+        BQ_DATASET_ID="benchmark",
+    )
+
+
+def run_app(registry, videos, concurrency):
+    """POST / of the web app, from the TikAPI search to the rendered final summary"""
+    from fastapi.testclient import TestClient
+    import app
+
+    app.ClientRegistry = lambda: registry
+    os.environ["DOWNLOAD_WORKERS"] = os.environ["DESCRIBE_WORKERS"] = str(concurrency)
+    with TestClient(app.app) as client:
+        response = client.post("/", data={"keyword": "benchmark", "video_number": str(videos)})
+    if response.status_code != 200:
+        raise RuntimeError(f"POST / failed with {response.status_code}: {response.text[:200]}")
+
+
+def run_cli(registry, videos, concurrency):
+    """main.py's per-keyword loop; it handles one video at a time whatever the concurrency"""
+    import main
+
+    asyncio.run(main.summarize_keyword("benchmark", videos, registry))
+
+
+def run_final_summary(registry, videos, concurrency):
+    """final_summary over `videos` generated descriptions, batched small enough to use the tree reduce.
+    When streamed, the time until the first text arrives is reported as the first_text stage."""
+    import utils
+
+    os.environ["FINAL_SUMMARY_CONCURRENCY"] = str(concurrency)
+    os.environ["FINAL_SUMMARY_BATCH_TOKENS"] = str(registry.final_batch_tokens)
+    summaries = [registry.gemini.describe() for _ in range(videos)]
+    on_text = None
+    if registry.stream:
+        start = time.perf_counter()
+        first_text = []
+
+        def on_text(text):
+            if not first_text:
+                first_text.append(time.perf_counter() - start)
+
+    utils.final_summary(summaries, "benchmark", client=registry.gemini, on_text=on_text)
+    if registry.stream:
+        registry.recorder.durations["first_text"].extend(first_text)
+
+
+def run_evaluate(registry, videos, concurrency):
+    """The evaluation of a final summary citing `videos` generated descriptions, chunked small enough to need
+    several concurrent calls"""
+    import evaluation
+
+    summaries = [registry.gemini.describe() for _ in range(videos)]
+    summary = registry.gemini.summarize("\n".join(f"{index}. {text}" for index, text in enumerate(summaries, 1)))
+    evaluation.evaluate_summary(summary, summaries, registry.gemini, budget=registry.final_batch_tokens,
+                                max_workers=concurrency)
+
+
+SCENARIOS = {"app": run_app, "cli": run_cli, "final_summary": run_final_summary, "evaluate": run_evaluate}
+
+
+def _percentiles(durations):
+    durations = np.array(durations)
+    return {"count": len(durations), "p50": float(np.percentile(durations, 50)),
+            "p95": float(np.percentile(durations, 95)), "mean": float(durations.mean())}
+
+
+def run_scenario(scenario, videos, concurrency, args):
+    registry, recorder = fake_registry(time_scale=args.time_scale, seed=args.seed,
+                                       video_bytes=args.video_kb * 1024, error_rate=args.error_rate, rpm=args.rpm)
+    registry.final_batch_tokens = args.final_batch_tokens
+    registry.stream = args.stream
+    registry.recorder = recorder
+    gemini = registry.gemini  # The app closes the registry on shutdown, which forgets its clients
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        SCENARIOS[scenario](registry, videos, concurrency)
+    finally:
+        seconds = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return {
+        "scenario": scenario,
+        "videos": videos,
+        "concurrency": concurrency,
+        "seconds": seconds,
+        "videos_per_second": videos / seconds,
+        "peak_memory_mb": peak / 1024 / 1024,
+        "gemini_rejections": gemini.rejected,
+        "stages": {stage: _percentiles(durations) for stage, durations in sorted(recorder.durations.items())},
+    }
+
+
+def compare(results, baseline, max_regression):
+    """Print the change of every run against the matching baseline run; return the regressions"""
+    previous = {(run["scenario"], run["videos"], run["concurrency"]): run for run in baseline["runs"]}
+    regressions = []
+    for run in results["runs"]:
+        key = (run["scenario"], run["videos"], run["concurrency"])
+        if key not in previous:
+            continue
+        old = previous[key]
+        changes = {"time/video": old["videos_per_second"] / run["videos_per_second"] - 1,
+                   "peak MB": run["peak_memory_mb"] / old["peak_memory_mb"] - 1}
+        for stage, stats in run["stages"].items():
+            if stage in old["stages"] and old["stages"][stage]["p95"] > 0:
+                changes[f"{stage} p95"] = stats["p95"] / old["stages"][stage]["p95"] - 1
+        # Positive changes are slowdowns or growth
+        print(f"{key[0]:<14} {key[1]:>5} videos x{key[2]:<3} " +
+              ", ".join(f"{name} {change:+.0%}" for name, change in changes.items()))
+        regressions.extend(f"{key}: {name} {change:+.0%}" for name, change in changes.items()
+                           if change > max_regression)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the summarization pipeline against local fakes.")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Comma separated: " + ",".join(SCENARIOS))
+    parser.add_argument("--videos", default="10,40", help="Comma separated video counts")
+    parser.add_argument("--concurrency", default="1,4", help="Comma separated stage worker counts")
+    parser.add_argument("--time-scale", type=float, default=0.05, help="Multiplier of the simulated latencies")
+    parser.add_argument("--video-kb", type=int, default=2048, help="Size of every simulated video")
+    parser.add_argument("--error-rate", type=float, default=0.01, help="Share of Gemini calls failing with a 503")
+    parser.add_argument("--rpm", type=int, default=2000, help="Gemini requests per simulated minute before 429s")
+    parser.add_argument("--final-batch-tokens", type=int, default=4000,
+                        help="Token budget of one final_summary or evaluation call, small enough to need several")
+    parser.add_argument("--stream", action="store_true", help="Stream the last call of the final_summary scenario")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark_results.json", help="Where to write the results")
+    parser.add_argument("--baseline", help="Earlier results to compare with")
+    parser.add_argument("--max-regression", type=float, default=0.2,
+                        help="Exit with an error if a metric is this much worse than the baseline")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="pipeline-bench-") as workdir:
+        _configure_env(workdir)
+        runs = []
+        for scenario in args.scenarios.split(","):
+            # The CLI is sequential, more workers wouldn't change anything
+            levels = [1] if scenario == "cli" else [int(level) for level in args.concurrency.split(",")]
+            for videos in [int(count) for count in args.videos.split(",")]:
+                for concurrency in levels:
+                    run = run_scenario(scenario, videos, concurrency, args)
+                    runs.append(run)
+                    stages = ", ".join(f"{stage} {stats['p50']:.3f}/{stats['p95']:.3f}s"
+                                       for stage, stats in run["stages"].items())
+                    print(f"{scenario:<14} {videos:>5} videos x{concurrency:<3} {run['videos_per_second']:7.2f} "
+                          f"videos/s, peak {run['peak_memory_mb']:.1f} MB | p50/p95 {stages}")
+
+    results = {"config": vars(args), "runs": runs}
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.max_regression)
+        if regressions:
+            print("Regressions against the baseline:\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Compare the bytes and time of each preprocessing mode against uploading the original video.
+
+Synthetic videos are generated locally with ffmpeg, so no TikTok or Gemini access is needed. Upload time is
+modelled from the payload size at `--upload-mbps`, as the real upload is what the modes try to shrink.
+
+    python -m benchmarks.preprocess_benchmark --videos 5 --seconds 30 --upload-mbps 20
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import tempfile
+
+from preprocess import MODES, ffmpeg_binary, preprocess_video
+
+
+def make_video(binary, path, seconds, size, seed):
+    """A TikTok-like vertical mp4 with moving content, so the encoder can't cheat on static frames"""
+    subprocess.run([
+        binary, "-hide_banner", "-loglevel", "error", "-y",
+        "-f", "lavfi", "-i", f"testsrc2=size={size}:rate=30:duration={seconds}",
+        "-f", "lavfi", "-i", f"sine=frequency={220 + 110 * seed}:duration={seconds}",
+        "-vf", f"noise=alls={10 + seed}:allf=t", "-c:v", "libx264", "-preset", "veryfast", "-b:v", "2500k",
+        "-g", "60", "-c:a", "aac", "-b:a", "128k", "-shortest", path,
+    ], check=True, capture_output=True)
+
+
+def run(videos, seconds, size, upload_mbps):
+    binary = ffmpeg_binary()
+    if binary is None:
+        raise SystemExit("ffmpeg is required to generate the synthetic videos")
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="preprocess-bench-") as workdir:
+        paths = []
+        for index in range(videos):
+            path = os.path.join(workdir, f"video_{index}.mp4")
+            make_video(binary, path, seconds, size, index)
+            paths.append(path)
+
+        for mode in MODES:
+            sizes, preprocess_seconds, files = [], [], []
+            for path in paths:
+                result = preprocess_video(path, mode)
+                try:
+                    sizes.append(result.processed_bytes)
+                    preprocess_seconds.append(result.seconds)
+                    files.append(len(result.paths))
+                finally:
+                    result.cleanup()
+            upload_seconds = [size_ * 8 / (upload_mbps * 1e6) for size_ in sizes]
+            results[mode] = {
+                "mean_bytes": statistics.mean(sizes),
+                "mean_files": statistics.mean(files),
+                "mean_preprocess_seconds": statistics.mean(preprocess_seconds),
+                "mean_upload_seconds": statistics.mean(upload_seconds),
+                "mean_total_seconds": statistics.mean(p + u for p, u in zip(preprocess_seconds, upload_seconds)),
+            }
+
+    baseline = results["none"]
+    for mode, result in results.items():
+        result["bytes_vs_none"] = result["mean_bytes"] / baseline["mean_bytes"]
+        result["time_vs_none"] = result["mean_total_seconds"] / baseline["mean_total_seconds"]
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark video preprocessing modes on synthetic videos.")
+    parser.add_argument("--videos", type=int, default=3, help="Number of synthetic videos")
+    parser.add_argument("--seconds", type=int, default=20, help="Length of each video")
+    parser.add_argument("--size", default="720x1280", help="Resolution of the synthetic videos")
+    parser.add_argument("--upload-mbps", type=float, default=20.0, help="Modelled upload bandwidth to Gemini")
+    parser.add_argument("--output", default="preprocess_benchmark.json", help="Where to write the results")
+    args = parser.parse_args()
+
+    results = run(args.videos, args.seconds, args.size, args.upload_mbps)
+    print(f"{'mode':<10} {'bytes':>12} {'files':>6} {'prep s':>8} {'upload s':>9} {'total s':>8} "
+          f"{'bytes x':>8} {'time x':>7}")
+    for mode, result in results.items():
+        print(f"{mode:<10} {result['mean_bytes']:>12.0f} {result['mean_files']:>6.1f} "
+              f"{result['mean_preprocess_seconds']:>8.2f} {result['mean_upload_seconds']:>9.2f} "
+              f"{result['mean_total_seconds']:>8.2f} {result['bytes_vs_none']:>8.2f} {result['time_vs_none']:>7.2f}")
+    with open(args.output, "w") as f:
+        json.dump({"config": vars(args), "results": results}, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
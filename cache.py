@@ -0,0 +1,252 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import record_cache_lookup
+
+
+def _digest(*parts):
+    return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+
+class _SQLiteCache:
+    """One SQLite table of cached values, shared by the caches below.
+
+    Subclasses name the `table` and its `columns` between the key and the timestamps, the last of which
+    holds the cached value. Entries older than `ttl_seconds` are dropped and the least recently used ones
+    are evicted once more than `max_entries` are stored. `_lookup` and `_store` expect `_lock` to be held.
+    """
+
+    table = None
+    columns = ()
+
+    def __init__(self, path, max_entries, ttl_seconds):
+        self.path = path
+        self.max_entries = int(max_entries)
+        self.ttl_seconds = float(ttl_seconds)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.table} (key TEXT PRIMARY KEY, "
+            + "".join(f"{column} TEXT, " for column in self.columns) + "created_at REAL, accessed_at REAL)"
+        )
+        self._conn.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_accessed ON {self.table} (accessed_at)")
+        self._conn.commit()
+
+    def _lookup(self, key, now):
+        """(value, created_at) of `key`, or None if it isn't cached or has expired"""
+        row = self._conn.execute(
+            f"SELECT {self.columns[-1]}, created_at FROM {self.table} WHERE key = ?", (key,)
+        ).fetchone()
+        if row is not None and now - row[1] > self.ttl_seconds:
+            self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+            self._conn.commit()
+            row = None
+        if row is None:
+            self.misses += 1
+            record_cache_lookup(self.table, False)
+            return None
+        self._conn.execute(f"UPDATE {self.table} SET accessed_at = ? WHERE key = ?", (now, key))
+        self._conn.commit()
+        self.hits += 1
+        record_cache_lookup(self.table, True)
+        return row
+
+    def _store(self, key, values, now):
+        """Insert or replace `key` with the `values` of `columns`, then drop expired and overflowing entries"""
+        placeholders = ", ".join("?" for _ in range(len(self.columns) + 3))
+        self._conn.execute(f"INSERT OR REPLACE INTO {self.table} VALUES ({placeholders})", (key, *values, now, now))
+        self._conn.execute(f"DELETE FROM {self.table} WHERE created_at < ?", (now - self.ttl_seconds,))
+        overflow = self._size() - self.max_entries
+        if overflow > 0:
+            self._conn.execute(
+                f"DELETE FROM {self.table} WHERE key IN "
+                f"(SELECT key FROM {self.table} ORDER BY accessed_at LIMIT ?)", (overflow,)
+            )
+        self._conn.commit()
+
+    def _size(self):
+        return self._conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+    def stats(self):
+        with self._lock:
+            size = self._size()
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": size}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class SummaryCache(_SQLiteCache):
+    """On-disk cache of per-video summaries.
+
+    Entries are keyed by the TikTok video id, a hash of the prompt, the model name and an optional variant
+    (e.g. the preprocessing mode), so changing any of them never serves a stale summary. Entries older than
+    `ttl_seconds` are dropped and the least recently used ones are evicted once more than `max_entries` are
+    stored.
+    """
+
+    table = "video_summaries"
+    columns = ("video_id", "model", "summary")
+
+    def __init__(self, path=None, max_entries=None, ttl_seconds=None):
+        super().__init__(path or os.environ.get("SUMMARY_CACHE_PATH", ".cache/summaries.sqlite"),
+                         max_entries or os.environ.get("SUMMARY_CACHE_MAX_ENTRIES", 100000),
+                         ttl_seconds or os.environ.get("SUMMARY_CACHE_TTL", 30 * 24 * 3600))
+
+    @staticmethod
+    def make_key(video_id, prompt, model, variant=""):
+        parts = [str(video_id), _digest(prompt), model]
+        if variant:
+            parts.append(variant)
+        return _digest(*parts)
+
+    def get(self, video_id, prompt, model, variant=""):
+        key = self.make_key(video_id, prompt, model, variant)
+        with self._lock:
+            row = self._lookup(key, time.time())
+        return row[0] if row is not None else None
+
+    def put(self, video_id, prompt, model, summary, variant=""):
+        key = self.make_key(video_id, prompt, model, variant)
+        with self._lock:
+            self._store(key, (str(video_id), model, summary), time.time())
+
+
+def summary_set_digest(summaries):
+    """Digest of a set of summaries that doesn't depend on the order they were read in"""
+    return _digest(*sorted(_digest(summary) for summary in summaries))
+
+
+class FinalSummaryCache(_SQLiteCache):
+    """Two-tier cache of final summaries: an in-memory LRU in front of an on-disk SQLite table.
+
+    Entries are keyed by the keyword, the model, the prompt version and an order-independent digest of the
+    source summaries, so a new or changed summary is a miss while the same rows read back in another order
+    are a hit. The cached value keeps the summaries in the order the result cites them by index.
+
+    The latest result of every keyword is also kept as its incremental state (see `get_state`), which
+    later updates fold new summaries into.
+    """
+
+    table = "final_summaries"
+    columns = ("keyword", "model", "value")
+
+    def __init__(self, path=None, memory_entries=None, max_entries=None, ttl_seconds=None):
+        super().__init__(path or os.environ.get("FINAL_SUMMARY_CACHE_PATH", ".cache/final_summaries.sqlite"),
+                         max_entries or os.environ.get("FINAL_SUMMARY_CACHE_MAX_ENTRIES", 10000),
+                         ttl_seconds or os.environ.get("FINAL_SUMMARY_CACHE_TTL", 7 * 24 * 3600))
+        self.memory_entries = int(memory_entries or os.environ.get("FINAL_SUMMARY_CACHE_MEMORY", 128))
+        self.memory_hits = 0
+        self._memory = OrderedDict()
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS final_summary_state ("
+            "keyword TEXT, model TEXT, prompt_version TEXT, state TEXT, updated_at REAL, "
+            "PRIMARY KEY (keyword, model, prompt_version))"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(keyword, model, prompt_version, summaries):
+        return _digest(keyword, model, str(prompt_version), summary_set_digest(summaries))
+
+    def get(self, keyword, model, prompt_version, summaries):
+        """The cached {"result", "prompt", "summaries"} for exactly this set of summaries, or None"""
+        key = self.make_key(keyword, model, prompt_version, summaries)
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and now - entry[1] <= self.ttl_seconds:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                record_cache_lookup("final_summaries", True)
+                return entry[0]
+            self._memory.pop(key, None)
+            row = self._lookup(key, now)
+            if row is None:
+                return None
+            value = json.loads(row[0])
+            self._remember(key, value, row[1])
+            return value
+
+    def put(self, keyword, model, prompt_version, summaries, result, prompt):
+        key = self.make_key(keyword, model, prompt_version, summaries)
+        value = {"result": result, "prompt": prompt, "summaries": list(summaries)}
+        now = time.time()
+        with self._lock:
+            self._store(key, (keyword, model, json.dumps(value)), now)
+            self._remember(key, value, now)
+
+    def get_state(self, keyword, model, prompt_version):
+        """The latest final summary of `keyword` together with the filenames it covers, or None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT state FROM final_summary_state WHERE keyword = ? AND model = ? AND prompt_version = ?",
+                (keyword, model, str(prompt_version))
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_state(self, keyword, model, prompt_version, state):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO final_summary_state VALUES (?, ?, ?, ?, ?)",
+                (keyword, model, str(prompt_version), json.dumps(state), time.time())
+            )
+            self._conn.commit()
+
+    def _remember(self, key, value, created_at):
+        self._memory[key] = (value, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            size = self._size()
+            in_memory = len(self._memory)
+        hits = self.memory_hits + self.hits
+        lookups = hits + self.misses
+        return {"memory_hits": self.memory_hits, "disk_hits": self.hits, "misses": self.misses,
+                "hit_rate": hits / lookups if lookups else 0.0, "memory_entries": in_memory, "entries": size}
+
+
+class EvaluationCache(_SQLiteCache):
+    """On-disk cache of summary evaluations.
+
+    Entries are keyed by the model, the prompt version, the final summary and the source summaries in order
+    (the evaluation refers to them by position), so evaluating the same result again costs no model call.
+    """
+
+    table = "evaluations"
+    columns = ("value",)
+
+    def __init__(self, path=None, max_entries=None, ttl_seconds=None):
+        super().__init__(path or os.environ.get("EVALUATION_CACHE_PATH", ".cache/evaluations.sqlite"),
+                         max_entries or os.environ.get("EVALUATION_CACHE_MAX_ENTRIES", 10000),
+                         ttl_seconds or os.environ.get("EVALUATION_CACHE_TTL", 30 * 24 * 3600))
+
+    @staticmethod
+    def make_key(model, prompt_version, summary, sources):
+        return _digest(model, str(prompt_version), _digest(summary), _digest(*sources))
+
+    def get(self, model, prompt_version, summary, sources):
+        key = self.make_key(model, prompt_version, summary, sources)
+        with self._lock:
+            row = self._lookup(key, time.time())
+        return json.loads(row[0]) if row is not None else None
+
+    def put(self, model, prompt_version, summary, sources, evaluation):
+        key = self.make_key(model, prompt_version, summary, sources)
+        with self._lock:
+            self._store(key, (json.dumps(evaluation),), time.time())
@@ -0,0 +1,98 @@
+import os
+import threading
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from google import genai
+from google.genai import types
+from google.cloud import bigquery
+from tikapi import TikAPI
+
+
+class ClientRegistry:
+    """Creates the Gemini, TikAPI and BigQuery clients once and shares them between threads and requests.
+
+    Clients are built lazily on first use, so credentials are only loaded for the services that are
+    actually needed. Gemini traffic goes through one pooled keep-alive `httpx.Client` and video downloads
+    through one pooled `requests.Session`. Pass `gemini_transport` (e.g. `httpx.MockTransport`) and/or
+    `bigquery_http` (a `requests.Session`) to swap the network layer for a stand-in.
+    """
+
+    def __init__(self, gemini_key=None, tikapi_key=None, project_id=None, pool_size=None,
+                 gemini_transport=None, bigquery_http=None):
+        self.gemini_key = gemini_key
+        self.tikapi_key = tikapi_key
+        self.project_id = project_id
+        self.pool_size = int(pool_size or os.environ.get("HTTP_POOL_SIZE", 20))
+        self.gemini_transport = gemini_transport
+        self.bigquery_http = bigquery_http
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def _get(self, name, factory):
+        client = self._clients.get(name)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(name)
+                if client is None:
+                    client = self._clients[name] = factory()
+        return client
+
+    @property
+    def gemini(self):
+        return self._get("gemini", self._create_gemini)
+
+    @property
+    def tikapi(self):
+        return self._get("tikapi", lambda: TikAPI(self.tikapi_key or os.environ["TIKAPI_KEY"]))
+
+    @property
+    def bigquery(self):
+        return self._get("bigquery", lambda: bigquery.Client(
+            project=self.project_id or os.environ.get("GCP_PROJECT_ID"), _http=self.bigquery_http))
+
+    @property
+    def http(self):
+        """Pooled keep-alive session for plain HTTP downloads such as the videos themselves"""
+        return self._get("http", self._create_http)
+
+    def _create_http(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def _create_gemini(self):
+        limits = httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size)
+        http_client = httpx.Client(limits=limits, transport=self.gemini_transport, timeout=httpx.Timeout(600.0))
+        self._clients["gemini_http"] = http_client
+        return genai.Client(api_key=self.gemini_key or os.environ["GEMINI_KEY"],
+                            http_options=types.HttpOptions(httpx_client=http_client))
+
+    def close(self):
+        with self._lock:
+            clients, self._clients = self._clients, {}
+        for name in ("gemini", "bigquery", "gemini_http", "http"):
+            if name in clients:
+                clients[name].close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+_default_registry = None
+_default_registry_lock = threading.Lock()
+
+
+def default_registry():
+    """Process-wide registry used when a caller doesn't pass its own clients"""
+    global _default_registry
+    with _default_registry_lock:
+        if _default_registry is None:
+            _default_registry = ClientRegistry()
+        return _default_registry
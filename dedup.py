@@ -0,0 +1,69 @@
+import os
+import re
+import zlib
+
+import numpy as np
+
+# MinHash signatures of PERMUTATIONS hashes, split into BANDS bands for locality-sensitive hashing.
+# Two summaries share a band with probability 1 - (1 - s^rows)^BANDS for Jaccard similarity s, i.e. ~0.99
+# at s = 0.7 and ~0.12 at s = 0.3, so only likely duplicates are compared.
+PERMUTATIONS = 128
+BANDS = 32
+_PRIME = np.uint64(4294967311)  # smallest prime above 2**32
+_WORD = re.compile(r"\w+")
+
+
+def shingles(text, size=3):
+    """32-bit hashes of the word `size`-grams of `text`"""
+    words = _WORD.findall(text.lower())
+    grams = [" ".join(words[i:i + size]) for i in range(max(1, len(words) - size + 1))]
+    return np.array(sorted({zlib.crc32(gram.encode("utf-8")) for gram in grams}), dtype=np.uint64)
+
+
+def minhash_signatures(texts, permutations=PERMUTATIONS, seed=0):
+    """(len(texts), permutations) MinHash matrix; the fraction of equal columns of two rows estimates the
+    Jaccard similarity of their shingle sets"""
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, 2 ** 32, size=permutations, dtype=np.uint64)
+    b = rng.integers(0, 2 ** 32, size=permutations, dtype=np.uint64)
+    signatures = np.empty((len(texts), permutations), dtype=np.uint64)
+    for row, text in enumerate(texts):
+        # a * h + b stays below 2**64 as every factor is below 2**32
+        signatures[row] = ((np.outer(a, shingles(text)) + b[:, None]) % _PRIME).min(axis=1)
+    return signatures
+
+
+def cluster_near_duplicates(texts, threshold=None):
+    """Group texts whose estimated Jaccard similarity to the first text of a group is at least `threshold`.
+
+    Returns lists of 0-based indices in order of first appearance, each starting with the text that
+    represents the group. Texts are compared to group representatives only, so groups don't chain.
+    """
+    threshold = float(threshold if threshold is not None else os.environ.get("DEDUP_THRESHOLD", 0.8))
+    if len(texts) < 2:
+        return [[index] for index in range(len(texts))]
+    signatures = minhash_signatures(texts)
+    rows = PERMUTATIONS // BANDS
+    buckets = [{} for _ in range(BANDS)]
+    clusters = []
+    cluster_of = {}
+    for index, signature in enumerate(signatures):
+        keys = [signature[band * rows:(band + 1) * rows].tobytes() for band in range(BANDS)]
+        candidates = {cluster_of[other] for band, key in enumerate(keys) for other in buckets[band].get(key, ())}
+        best, best_similarity = None, threshold
+        if candidates:
+            candidates = sorted(candidates)
+            representatives = signatures[[clusters[cluster][0] for cluster in candidates]]
+            similarities = (representatives == signature).mean(axis=1)
+            top = int(similarities.argmax())
+            if similarities[top] >= best_similarity:
+                best, best_similarity = candidates[top], similarities[top]
+        if best is None:
+            best = len(clusters)
+            clusters.append([])
+            # Only representatives are bucketed, they are the only texts anything is compared to
+            for band, key in enumerate(keys):
+                buckets[band].setdefault(key, []).append(index)
+        clusters[best].append(index)
+        cluster_of[index] = best
+    return clusters
@@ -0,0 +1,226 @@
+import logging
+import os
+import re
+
+from dedup import cluster_near_duplicates
+from metrics import span, record_model_call, run_in_threads
+from rate_limit import gemini_limiter, with_backoff
+from summarize import pack_batches, parse_summary_json, split_citations, token_estimator
+
+logger = logging.getLogger(__name__)
+
+EVALUATION_MODEL = "gemini-1.5-pro"
+# Bump whenever evaluation_prompt changes, so cached evaluations are redone
+EVALUATION_PROMPT_VERSION = 1
+_SENTENCE_END = re.compile(r"(?<=[.!?。！？])\s+")
+
+
+class EvaluationError(Exception):
+    pass
+
+
+def split_sentences(summary, total):
+    """(text, text without citations, cited indices) of every sentence of a final summary.
+
+    `summary` may be the final summary's JSON, whose "summary" field is used then.
+    """
+    parsed = parse_summary_json(summary)
+    if parsed is not None and isinstance(parsed.get("summary"), str):
+        summary = parsed["summary"]
+    sentences = []
+    for text in _SENTENCE_END.split(summary.strip()):
+        plain, cited = split_citations(text, total)
+        if sentences and not plain.strip(".!?。！？ "):
+            # A citation placed after the full stop belongs to the sentence before it
+            previous, previous_plain, previous_cited = sentences[-1]
+            sentences[-1] = (f"{previous} {text}", previous_plain, previous_cited | cited)
+        elif text:
+            sentences.append((text, plain, cited))
+    return sentences
+
+
+def evaluation_prompt(sentences, sources):
+    """Prompt asking which of the numbered `sources`, (number, text) pairs, support each of `sentences`"""
+    numbered_sources = "\n------------------------\n".join(f"{number}. {text}" for number, text in sources)
+    numbered_sentences = "\n".join(f"S{number}. {text}" for number, text in enumerate(sentences, 1))
+    return f"""
+    You are an AI expert in evaluating text summarization accuracy. Your task is to trace the sentences of a
+    **Final Summary** back to the **Source Summaries** they are based on.
+
+    Here are source summaries from different videos, each with its number and separated by a line separator.
+    They may be only a part of all sources:
+    {numbered_sources}
+
+    Below are the numbered sentences of the final summary:
+    {numbered_sentences}
+
+    ### **Tasks**
+    1. For every sentence, list the numbers of the Source Summaries above that contain the information in the
+       sentence. Only use numbers shown above, and an empty list if none of them does. Tell the reason of your
+       judgement.
+    2. Identify important content of the Source Summaries above that is missing in the Final Summary.
+       A content is considered important if it appears in several sources, or contains unique or major
+       information that is not covered in any sentence. Provide the missing sentence and list the sources
+       where it appeared.
+
+    Return ALL your response in the following structured JSON format:
+    IMPORTANT: Please make sure the output value is able to be parsed by json.loads.
+    {{
+        "sentences": [
+            {{ "sentence": 1, "sources": [1, 4], "reasons": "Source 1 is blablabla, source 4 is blablabla." }}
+        ],
+        "missing_sentences": [
+            {{ "text": "Important missing sentence", "source": [2, 5], "reasons": "Source 2 is blablabla." }}
+        ]
+    }}
+    """
+
+
+def _as_int(value):
+    """`value` as an int if the model gave a whole number, also written as a string, else None"""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str) and value.strip().isdigit():
+        return int(value)
+    return value if isinstance(value, int) else None
+
+
+def _entries(result, key):
+    """The dict entries of the list `result[key]`, anything else the model put there is skipped"""
+    entries = result.get(key)
+    return [entry for entry in entries if isinstance(entry, dict)] if isinstance(entries, list) else []
+
+
+def _source_numbers(values, numbers):
+    """The numbers in `values` that are among `numbers`, as numbers outside of a chunk are made up"""
+    values = values if isinstance(values, list) else [values]
+    return {number for number in map(_as_int, values) if number in numbers}
+
+
+def _evaluate_chunk(sentences, sources, model, client, estimator, limiter):
+    """Sources supporting each sentence and the missing content, within one chunk of (number, text) sources.
+
+    An unparseable response is asked for once more; None is returned if that one can't be parsed either.
+    """
+    prompt = evaluation_prompt(sentences, sources)
+    estimated_tokens = estimator.estimate(prompt)
+
+    def send():
+        limiter.acquire(estimated_tokens)
+        return client.models.generate_content(model=model, contents=[prompt])
+
+    for attempt in range(2):
+        with span("evaluate_generate"):
+            response = with_backoff(send)
+        usage = response.usage_metadata
+        record_model_call(model, "evaluate", usage)
+        if usage is not None:
+            estimator.calibrate(prompt, usage.prompt_token_count)
+            limiter.record(estimated_tokens, usage.total_token_count)
+        result = parse_summary_json(response.text or "")
+        if result is not None:
+            break
+        logger.warning("Could not parse the evaluation response (attempt %d): %s", attempt + 1,
+                       (response.text or "")[:200])
+    else:
+        return None
+
+    numbers = {number for number, _ in sources}
+    supported = [set() for _ in sentences]
+    reasons = [[] for _ in sentences]
+    for entry in _entries(result, "sentences"):
+        index = _as_int(entry.get("sentence"))
+        if index is not None and 1 <= index <= len(sentences):
+            supported[index - 1].update(_source_numbers(entry.get("sources", []), numbers))
+            if entry.get("reasons"):
+                reasons[index - 1].append(str(entry["reasons"]))
+    missing = [{"text": str(entry["text"]),
+                "source": sorted(_source_numbers(entry.get("source", []), numbers)),
+                "reasons": str(entry.get("reasons", ""))}
+               for entry in _entries(result, "missing_sentences") if entry.get("text")]
+    return supported, reasons, missing
+
+
+def _merge_missing(missing):
+    """Missing content found in several chunks, with near-duplicates merged into one entry"""
+    merged = []
+    for cluster in cluster_near_duplicates([entry["text"] for entry in missing]):
+        entries = [missing[index] for index in cluster]
+        merged.append({
+            "text": entries[0]["text"],
+            "source": sorted({number for entry in entries for number in entry["source"]}),
+            "reasons": " ".join(dict.fromkeys(entry["reasons"] for entry in entries if entry["reasons"])),
+        })
+    return merged
+
+
+def _score(text, cited, supported, reasons):
+    # Nothing cited has no incorrect reference, nothing supporting it has no missing one
+    correct = cited & supported
+    errors = []
+    if cited - supported:
+        errors.append(f"Incorrect source: {sorted(cited - supported)}")
+    if supported - cited:
+        errors.append(f"Missing source: {sorted(supported - cited)}")
+    if not supported:
+        errors.append("No source contains this sentence")
+    if errors and reasons:
+        errors.append("Reasons: " + " ".join(dict.fromkeys(reasons)))
+    return {
+        "text": text,
+        "precision": len(correct) / len(cited) if cited else 1.0,
+        "recall": len(correct) / len(supported) if supported else 1.0,
+        "errors": errors,
+    }
+
+
+def evaluate_summary(summary, sources, client, cache=None, model=EVALUATION_MODEL, budget=None, max_workers=None):
+    """Sentence-level precision and recall of the citations in `summary`, and the content it misses.
+
+    `sources` are the summaries the citations number from 1. They are split into chunks of at most `budget`
+    estimated tokens that are judged concurrently, each returning which of its sources support every
+    sentence, so the latency stays flat as sources grow. Precision and recall are computed here from the
+    cited and the supporting sources. Returns {"precision_recall", "missing_sentences"}, and
+    "unevaluated_sources" if the responses for some of the sources couldn't be parsed.
+    """
+    sources = [str(source) for source in sources]
+    if cache is not None:
+        cached = cache.get(model, EVALUATION_PROMPT_VERSION, summary, sources)
+        if cached is not None:
+            return cached
+
+    budget = budget or int(os.environ.get("EVALUATION_BATCH_TOKENS", 32000))
+    max_workers = max_workers or int(os.environ.get("EVALUATION_CONCURRENCY", 8))
+    sentences = split_sentences(summary, len(sources))
+    estimator = token_estimator(model)
+    limiter = gemini_limiter(model)
+    overhead = estimator.estimate(evaluation_prompt([plain for _, plain, _ in sentences], []))
+    chunks = pack_batches(sources, max(1, budget - overhead), estimator.estimate)
+
+    def evaluate_chunk(chunk):
+        return _evaluate_chunk([plain for _, plain, _ in sentences], [(index + 1, sources[index]) for index in chunk],
+                               model, client, estimator, limiter)
+
+    results = run_in_threads(evaluate_chunk, chunks, max_workers)
+
+    # A chunk whose response couldn't be parsed leaves its sources unjudged instead of failing the rest
+    unevaluated = {index + 1 for chunk, result in zip(chunks, results) if result is None for index in chunk}
+    results = [result for result in results if result is not None]
+    if chunks and not results:
+        raise EvaluationError("Failed to parse model response")
+    supported = [set().union(*(result[0][index] for result in results)) for index in range(len(sentences))]
+    reasons = [[reason for result in results for reason in result[1][index]] for index in range(len(sentences))]
+    evaluation = {
+        "precision_recall": [_score(text, cited - unevaluated, supported[index], reasons[index])
+                             for index, (text, _, cited) in enumerate(sentences)],
+        "missing_sentences": _merge_missing([entry for result in results for entry in result[2]]),
+    }
+    if unevaluated:
+        logger.warning("Sources %s could not be evaluated", sorted(unevaluated))
+        evaluation["unevaluated_sources"] = sorted(unevaluated)
+    elif cache is not None:
+        # Partial evaluations aren't cached, so the next request judges every source again
+        cache.put(model, EVALUATION_PROMPT_VERSION, summary, sources, evaluation)
+    return evaluation
@@ -0,0 +1,166 @@
+import asyncio
+import contextvars
+import itertools
+import time
+import uuid
+from collections import deque
+
+
+# Job whose worker is running in the current context, used to route progress messages
+current_job = contextvars.ContextVar("current_job", default=None)
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class Job:
+    """A submitted run with its own progress channel.
+
+    The last `replay_size` progress messages are kept, so a client that (re)connects can catch up from the
+    last sequence number it has seen.
+    """
+
+    max_pending = 1000
+
+    def __init__(self, key, params, replay_size=200):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.params = params
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.events = deque(maxlen=replay_size)
+        self.subscribers = set()
+        self.done = asyncio.Event()
+        self._seq = itertools.count(1)
+        self._last_key = None
+
+    def publish(self, message, key=None, **data):
+        """Send `message` and any extra `data` to the subscribers.
+
+        Consecutive events with the same `key` supersede each other in the replay buffer, so a stream of
+        partial results doesn't push the earlier messages out of it.
+        """
+        event = {"seq": next(self._seq), "message": message, **data}
+        if key is not None and key == self._last_key and self.events:
+            self.events.pop()
+        self._last_key = key
+        self.events.append(event)
+        for queue in list(self.subscribers):
+            if queue.qsize() >= self.max_pending:
+                # A subscriber that can't keep up is cut off, it can reconnect and replay from the buffer
+                self.subscribers.discard(queue)
+                queue.put_nowait(None)
+            else:
+                queue.put_nowait(event)
+
+    def subscribe(self, after=0):
+        """Return the buffered events after sequence number `after` and a queue receiving the new ones.
+
+        The queue yields None once the job has finished or the subscriber fell too far behind.
+        """
+        queue = asyncio.Queue()
+        if self.done.is_set():
+            queue.put_nowait(None)
+        else:
+            self.subscribers.add(queue)
+        return [event for event in self.events if event["seq"] > after], queue
+
+    def unsubscribe(self, queue):
+        self.subscribers.discard(queue)
+
+    def finish(self, status, result=None, error=None):
+        self.status = status
+        self.result = result
+        self.error = error
+        self.finished_at = time.time()
+        self.done.set()
+        for queue in self.subscribers:
+            queue.put_nowait(None)
+        self.subscribers.clear()
+
+    def describe(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "params": self.params,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "error": self.error,
+            "last_seq": self.events[-1]["seq"] if self.events else 0,
+        }
+
+
+class JobManager:
+    """Runs submitted jobs on a fixed pool of asyncio workers.
+
+    At most `max_queued` jobs wait for a worker. Submitting parameters identical to a job that is still
+    queued or running returns that job instead of starting another one. Finished jobs are kept for
+    `retention` seconds so their status and result can still be fetched.
+    """
+
+    def __init__(self, runner, workers=2, max_queued=20, replay_size=200, retention=3600):
+        self.runner = runner
+        self.workers = workers
+        self.replay_size = replay_size
+        self.retention = retention
+        self.jobs = {}
+        self._in_flight = {}
+        self._queue = asyncio.Queue(maxsize=max_queued)
+        self._tasks = []
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, **params):
+        """Return (job, created); raises QueueFullError if too many jobs are waiting"""
+        self._prune()
+        key = tuple(sorted(params.items()))
+        job = self._in_flight.get(key)
+        if job is not None:
+            return job, False
+        job = Job(key, params, replay_size=self.replay_size)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise QueueFullError(f"{self._queue.qsize()} jobs are already waiting")
+        self.jobs[job.id] = job
+        self._in_flight[key] = job
+        job.publish("⏳ Job queued...")
+        return job, True
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def _prune(self):
+        now = time.time()
+        for job_id, job in list(self.jobs.items()):
+            if job.finished_at is not None and now - job.finished_at > self.retention:
+                del self.jobs[job_id]
+
+    async def _work(self):
+        while True:
+            job = await self._queue.get()
+            job.status = "running"
+            job.started_at = time.time()
+            token = current_job.set(job)
+            try:
+                result = await self.runner(**job.params)
+                job.finish("succeeded", result=result)
+            except Exception as e:
+                job.publish(f"❌ {e}")
+                job.finish("failed", error=str(e))
+            finally:
+                current_job.reset(token)
+                self._in_flight.pop(job.key, None)
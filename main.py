@@ -1,12 +1,27 @@
 import argparse
-from utils import (query_response_from_tikapi, download_video_from_response, describe_video,
-                   create_bigquery_table, write_summary_to_bq, final_summary)
+import asyncio
+import datetime
+import json
+from contextlib import aclosing
+from utils import (query_response_from_tikapi, download_video, describe_video, DESCRIBE_MODEL,
+                   cached_final_summary)
+from clients import ClientRegistry
+from cache import SummaryCache, FinalSummaryCache
+from storage import SummarySink, SummaryWriteError, open_summary_store, check_keyword
+from video_store import VideoStore, VideoTooLargeError
+from preprocess import MODES as PREPROCESS_MODES, stats as preprocess_stats, cache_variant, effective_mode
+from metrics import RequestTiming, current_timing, span
+from manifest import Manifest
+from summarize import parse_summary_json
 from dotenv import load_dotenv
+import logging
 import os
 from tqdm import tqdm
 
 
 load_dotenv("test.env")
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger("main")
 PROMPT = ("Summarize this video. I hope to know the following, but it depends on you to decide if those are applicable."
           "1. Tell what are the objects in the video, the properties of them, and what's the relationship between them."
           "2. Tell what events are happening in this video. "
@@ -17,47 +32,246 @@ PROMPT = ("Summarize this video. I hope to know the following, but it depends on
 # TODO: Optimize this prompt, objects/property/relationship, events, actions, vibe/environment
 # TODO: In-context Learning
 
+class Run:
+    """Stores and caches shared by every keyword of one CLI run, and the batch manifest if there is one"""
+
+    def __init__(self, clients, manifest=None):
+        self.clients = clients
+        self.manifest = manifest
+        self.summary_store = open_summary_store(lambda: clients.bigquery)
+        # Videos are checkpointed as stored as soon as the sink has written them, not when the keyword ends
+        on_stored = None
+        if manifest is not None:
+            on_stored = lambda table_id, rows: manifest.mark_stored(table_id, [row["filename"] for row in rows])
+        self.summary_sink = SummarySink(self.summary_store, on_stored=on_stored)
+        self.summary_cache = SummaryCache()
+        self.final_summary_cache = FinalSummaryCache()
+        self.video_store = VideoStore(session=clients.http)
+
+    def close(self):
+        try:
+            self.summary_sink.close()
+        except SummaryWriteError as e:
+            # The keywords of these rows already failed when they were flushed
+            logger.error("%s", e)
+        finally:
+            self.summary_store.close()
+
+
+def replay_unstored(keyword, run, videos):
+    """Write the manifest `videos` of `keyword` that were described but not marked stored, e.g. before a crash.
+
+    Some may have been written after all. BigQuery only drops a repeated row id on a best-effort basis for a
+    short while, so the rows stored since the first of them was described are checked first.
+    """
+    videos = [video for video in videos if not video["stored"]]
+    if not videos:
+        return
+    # A second of slack for rounding, rows stored earlier than that can't be of this run
+    since = min(video["updated_at"] for video in videos) - 1
+    with span("store_read"):
+        stored = {row["filename"] for row in run.summary_store.iter_rows(keyword, since=since)}
+    run.manifest.mark_stored(keyword, [video["filename"] for video in videos if video["filename"] in stored])
+    for video in videos:
+        if video["filename"] not in stored:
+            run.summary_sink.write(keyword, video["filename"], video["summary"],
+                                   row_id=f"{run.manifest.run_id}/{video['filename']}")
+
+
+async def summarize_keyword(keyword, video_number, clients, preprocess="none", run=None):
+    """Describe up to `video_number` videos of `keyword` into the summary store and return how many were stored.
+
+    With a manifest, videos described by an earlier attempt of the run count towards `video_number` and are
+    neither downloaded nor described again.
+    """
+    own_run = run is None
+    run = run or Run(clients)
+    manifest = run.manifest
+    # Before iterate through videos, make sure the keyword's table is created in advance
+    await asyncio.to_thread(run.summary_store.ensure_table, keyword)
+    done = {}
+    if manifest:
+        done = {video["video_id"]: video for video in await asyncio.to_thread(manifest.videos, keyword)}
+        await asyncio.to_thread(replay_unstored, keyword, run, list(done.values()))
+
+    # Batch runs log per keyword instead of drawing a progress bar for each
+    progress = tqdm(total=video_number, initial=min(len(done), video_number), disable=manifest is not None,
+                    desc="Generating description of videos and insert to BQ...")
+    # Summaries of preprocessed videos are cached apart from those of the original videos
+    variant = cache_variant(effective_mode(preprocess))
+    stored = len(done)
+    try:
+        if stored < video_number:
+            # Videos are streamed from tikapi page by page, so processing starts with the first page.
+            # Videos done before are found again by the search, so as many more are expected. Skipped videos
+            # make the search page on, until enough were stored.
+            logger.info("Getting response from tikapi for %s...", keyword)
+            videos = query_response_from_tikapi(keyword=keyword, video_number=video_number + len(done),
+                                                 api=clients.tikapi)
+            async with aclosing(videos):
+                async for page, item in videos:
+                    if item['id'] in done:
+                        continue
+                    # Download video to local, describe it and insert the description to BQ.
+                    # Videos described before with the same prompt and model are taken from the cache.
+                    filename = f"{keyword}/{item['id']}.mp4"
+                    summary = await asyncio.to_thread(run.summary_cache.get, item['id'], PROMPT, DESCRIBE_MODEL,
+                                                      variant)
+                    if summary is None:
+                        try:
+                            path = await asyncio.to_thread(download_video, page, item, store=run.video_store)
+                        except VideoTooLargeError as e:
+                            logger.info("Skipping video %s: %s", item['id'], e)
+                            continue
+                        try:
+                            summary, mode = await asyncio.to_thread(describe_video, path, PROMPT, DESCRIBE_MODEL,
+                                                                    client=clients.gemini, preprocess=preprocess)
+                        finally:
+                            run.video_store.unpin(item['id'])
+                        await asyncio.to_thread(run.summary_cache.put, item['id'], PROMPT, DESCRIBE_MODEL, summary,
+                                                cache_variant(mode))
+                    row_id = None
+                    if manifest:
+                        await asyncio.to_thread(manifest.record_described, keyword, item['id'], filename, summary)
+                        row_id = f"{manifest.run_id}/{filename}"
+                    # A full buffer is written right away, with retries, which must not block other keywords
+                    await asyncio.to_thread(run.summary_sink.write, keyword, filename, summary, row_id=row_id)
+                    stored += 1
+                    progress.update(1)
+                    if stored >= video_number:
+                        # Checked before pulling the next item, which could start another search
+                        break
+    finally:
+        progress.close()
+        try:
+            # Whatever was described is stored, also when a later video failed. Rows the store keeps
+            # rejecting fail the keyword, so a resumed batch writes them again.
+            await asyncio.to_thread(run.summary_sink.flush, keyword)
+        finally:
+            if own_run:
+                run.close()
+    logger.info("Stored %d videos for %s", stored, keyword)
+    return stored
+
+
+def summarize_stored(keyword, run):
+    """Final summary of every summary stored for `keyword`, as (result, summaries, prompt)"""
+    with span("store_read"):
+        rows = [(row['filename'], row['summary'].replace('\n', ''))
+                for row in run.summary_store.iter_rows(keyword) if row['summary']]
+    if not rows:
+        raise ValueError(f"No summaries found for keyword: {keyword}")
+    with span("final_summary"):
+        return cached_final_summary(rows, keyword, run.final_summary_cache, client=run.clients.gemini)
+
+
+async def process_keyword(keyword, video_number, run, preprocess="none"):
+    """Collect and summarize one keyword of a batch; returns its result with timings, also on failure.
+    Keywords that succeeded earlier in the run are returned from the manifest."""
+    previous = run.manifest.result(keyword)
+    if previous is not None and previous["status"] == "succeeded":
+        logger.info("%s is already done in this run", keyword)
+        return previous
+    # Every keyword runs in its own task, so the timing only covers this keyword
+    timing = RequestTiming()
+    current_timing.set(timing)
+    try:
+        check_keyword(keyword)
+        await summarize_keyword(keyword, video_number, run.clients, preprocess, run=run)
+        result, summaries, _ = await asyncio.to_thread(summarize_stored, keyword, run)
+        parsed = parse_summary_json(result) or {}
+        entry = {"keyword": keyword, "status": "succeeded", "videos": len(summaries),
+                 "summary": parsed.get("summary", result), "justification": parsed.get("justification", ""),
+                 "exclusion": parsed.get("exclusion", ""), "timings": timing.as_dict()}
+    except Exception as e:
+        logger.exception("Failed to process %s", keyword)
+        entry = {"keyword": keyword, "status": "failed", "error": str(e), "timings": timing.as_dict()}
+    run.manifest.put_result(keyword, entry)
+    return entry
+
+
+def read_keywords(path):
+    """Keywords of a file with one per line; blank lines and lines starting with # are ignored"""
+    with open(path) as f:
+        keywords = [line.strip() for line in f]
+    return list(dict.fromkeys(keyword for keyword in keywords if keyword and not keyword.startswith("#")))
+
+
+async def run_batch(keywords, video_number, clients, manifest, preprocess="none", workers=4):
+    """Process `keywords` with `workers` of them at a time and return their results in the given order.
+
+    Gemini and TikAPI calls of all workers share the process-wide rate limits.
+    """
+    run = Run(clients, manifest)
+    slots = asyncio.Semaphore(workers)
+
+    async def worker(keyword):
+        async with slots:
+            logger.info("Processing %s", keyword)
+            return await process_keyword(keyword, video_number, run, preprocess)
+
+    try:
+        return await asyncio.gather(*(worker(keyword) for keyword in keywords))
+    finally:
+        await asyncio.to_thread(run.close)
+
+
+async def run_single(keyword, video_number, clients, preprocess="none"):
+    # Time spent per stage, tokens and bytes of this keyword, printed at the end
+    timing = RequestTiming()
+    current_timing.set(timing)
+    run = Run(clients)
+    try:
+        await summarize_keyword(keyword, video_number, clients, preprocess, run=run)
+        print(f"Summary cache: {run.summary_cache.stats()}")
+        print(f"Video store: {run.video_store.stats()}")
+        print(f"Preprocessing: {preprocess_stats()}")
+        print(f"Generating final summary of those videos. ")
+        result, _, _ = await asyncio.to_thread(summarize_stored, keyword, run)
+    finally:
+        run.close()
+    print(result)
+    with open(f'{keyword}.txt', 'w') as f:
+        f.write(result)
+    print(f"Timings: {timing.as_dict()}")
+
+
 def main():
     parser = argparse.ArgumentParser(description="Process keyword and cache usage.")
-    parser.add_argument("--keyword", type=str, required=True, help="Keyword to process")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--keyword", type=str, help="Keyword to process")
+    target.add_argument("--keywords_file", type=str,
+                        help="File with one keyword per line, processed as a resumable batch. ")
     parser.add_argument("--minimal_video_number", type=int, default=40, help="Number of videos to download. ")
-    parser.add_argument("--use_bq_cache", action="store_true", 
-                        help="Flag to use existing table in BQ. By default, the table will be re-initialized. ")
+    parser.add_argument("--preprocess", choices=PREPROCESS_MODES, default="none",
+                        help="Shrink videos with ffmpeg before they are sent to Gemini. ")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("BATCH_WORKERS", 4)),
+                        help="Keywords processed at the same time in batch mode. ")
+    parser.add_argument("--run_id", default=datetime.date.today().isoformat(),
+                        help="Batch runs with the same id resume each other, by default one run per day. ")
+    parser.add_argument("--manifest", default=None, help="Checkpoint file of batch runs. ")
+    parser.add_argument("--output", default="batch_results.json", help="Where batch mode writes its results. ")
 
     args = parser.parse_args()
         
-    # Query response from tikapi
-    print("Getting response from tikapi...")
-    response_ls = query_response_from_tikapi(keyword=args.keyword, video_number=args.minimal_video_number)
-    print(f"Take {len(response_ls)} queries to reach more than {args.minimal_video_number} videos. ")
-    
-    # Before iterate through each response, make sure the bigquery table is created in advance
-    create_bigquery_table(table_id=args.keyword)
-    
-    # Iterate through responses
-    for idx, response in enumerate(response_ls):
-        print(f"Processing Response {idx}: with {len(response.json()['item_list'])} videos. Now downloading...")
-        # Download videos to local from response list
-        paths = download_video_from_response(response, directory=args.keyword)
-        # Describe each video from paths
-        for path in tqdm(paths, desc="Generating description of videos and insert to BQ..."):
-            summary = describe_video(path, PROMPT)
-            write_summary_to_bq(
-                project_id=os.environ["GCP_PROJECT_ID"],
-                dataset_id=os.environ["BQ_DATASET_ID"],
-                table_id=args.keyword,
-                filename=path,
-                summary=summary
-            )
-    print(f"Generating final summary of those videos. ")
-    result = final_summary(
-        project_id=os.environ["GCP_PROJECT_ID"],
-        dataset_id=os.environ["BQ_DATASET_ID"],
-        table_id=args.keyword
-    )
-    print(result)
-    with open(f'{args.keyword}.txt', 'w') as f:
-        f.write(result)
+    # Clients are shared by every step and closed once the run is over
+    with ClientRegistry() as clients:
+        if args.keyword:
+            asyncio.run(run_single(args.keyword, args.minimal_video_number, clients, args.preprocess))
+            return
+        keywords = read_keywords(args.keywords_file)
+        manifest = Manifest(args.manifest, run_id=args.run_id)
+        try:
+            results = asyncio.run(run_batch(keywords, args.minimal_video_number, clients, manifest,
+                                            args.preprocess, args.workers))
+        finally:
+            manifest.close()
+    with open(args.output, "w") as f:
+        json.dump({"run_id": args.run_id, "keywords": results}, f, indent=2, ensure_ascii=False)
+    failed = [result["keyword"] for result in results if result["status"] != "succeeded"]
+    print(f"{len(results) - len(failed)}/{len(results)} keywords summarized, results written to {args.output}")
+    if failed:
+        print(f"Failed: {', '.join(failed)}. Run again with --run_id {args.run_id} to retry them.")
 
 
 if __name__ == "__main__":
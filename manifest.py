@@ -0,0 +1,77 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class Manifest:
+    """SQLite checkpoint of a batch run, so a crashed run resumes where it stopped.
+
+    Every described video is recorded with its summary and marked once it is in the summary store, and
+    every finished keyword with its result. Entries belong to a `run_id`, so the next run starts over
+    while a rerun of the same run skips what is done.
+    """
+
+    def __init__(self, path=None, run_id=""):
+        self.path = path or os.environ.get("BATCH_MANIFEST_PATH", ".cache/batch_manifest.sqlite")
+        self.run_id = run_id
+        self._lock = threading.Lock()
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS videos ("
+            "run_id TEXT, keyword TEXT, video_id TEXT, filename TEXT, summary TEXT, stored INTEGER, updated_at REAL, "
+            "PRIMARY KEY (run_id, keyword, video_id))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS keywords ("
+            "run_id TEXT, keyword TEXT, result TEXT, updated_at REAL, PRIMARY KEY (run_id, keyword))"
+        )
+        self._conn.commit()
+
+    def videos(self, keyword):
+        """The videos of `keyword` described so far in this run, as
+        {"video_id", "filename", "summary", "stored", "updated_at"}"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT video_id, filename, summary, stored, updated_at FROM videos WHERE run_id = ? AND keyword = ? "
+                "ORDER BY updated_at", (self.run_id, keyword)
+            ).fetchall()
+        return [{"video_id": video_id, "filename": filename, "summary": summary, "stored": bool(stored),
+                 "updated_at": updated_at}
+                for video_id, filename, summary, stored, updated_at in rows]
+
+    def record_described(self, keyword, video_id, filename, summary):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO videos VALUES (?, ?, ?, ?, ?, 0, ?)",
+                (self.run_id, keyword, str(video_id), filename, summary, time.time())
+            )
+            self._conn.commit()
+
+    def mark_stored(self, keyword, filenames):
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE videos SET stored = 1 WHERE run_id = ? AND keyword = ? AND filename = ?",
+                [(self.run_id, keyword, filename) for filename in filenames]
+            )
+            self._conn.commit()
+
+    def result(self, keyword):
+        """The result recorded for `keyword` in this run, or None"""
+        with self._lock:
+            row = self._conn.execute("SELECT result FROM keywords WHERE run_id = ? AND keyword = ?",
+                                     (self.run_id, keyword)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_result(self, keyword, result):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO keywords VALUES (?, ?, ?, ?)",
+                               (self.run_id, keyword, json.dumps(result), time.time()))
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,193 @@
+import bisect
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+# Upper bounds in seconds, from a cache lookup to a long Gemini video analysis
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _label_text(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{str(value)}"' for name, value in labels) + "}"
+
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        lines.extend(f"{self.name}{_label_text(key)} {value}" for key, value in values)
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0}
+            series["counts"][index] += 1
+            series["sum"] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((key, list(value["counts"]), value["sum"]) for key, value in self._series.items())
+        for key, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_label_text(key + (('le', bound),))} {cumulative}")
+            lines.append(f"{self.name}_sum{_label_text(key)} {total}")
+            lines.append(f"{self.name}_count{_label_text(key)} {cumulative}")
+        return lines
+
+
+STAGE_SECONDS = Histogram("summarizer_stage_seconds", "Time spent in each pipeline stage")
+STAGE_ERRORS = Counter("summarizer_stage_errors_total", "Stage runs that raised an error")
+MODEL_CALLS = Counter("summarizer_model_calls_total", "Gemini generate calls")
+MODEL_TOKENS = Counter("summarizer_model_tokens_total", "Gemini tokens by direction (input or output)")
+UPLOAD_BYTES = Counter("summarizer_upload_bytes_total", "Bytes of video or frames sent to Gemini")
+DOWNLOAD_BYTES = Counter("summarizer_download_bytes_total", "Bytes of video downloaded")
+CACHE_LOOKUPS = Counter("summarizer_cache_lookups_total", "Cache lookups by cache and result (hit or miss)")
+_METRICS = (STAGE_SECONDS, STAGE_ERRORS, MODEL_CALLS, MODEL_TOKENS, UPLOAD_BYTES, DOWNLOAD_BYTES, CACHE_LOOKUPS)
+
+
+class RequestTiming:
+    """Time per stage and model usage of one request or job, summed over every call in it"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.totals = {}
+        self._lock = threading.Lock()
+
+    def add_stage(self, stage, seconds):
+        with self._lock:
+            entry = self.stages.setdefault(stage, {"calls": 0, "seconds": 0.0})
+            entry["calls"] += 1
+            entry["seconds"] += seconds
+
+    def add(self, name, amount):
+        with self._lock:
+            self.totals[name] = self.totals.get(name, 0) + amount
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "total_seconds": round(time.perf_counter() - self.start, 3),
+                "stages": {stage: {"calls": entry["calls"], "seconds": round(entry["seconds"], 3)}
+                           for stage, entry in self.stages.items()},
+                **self.totals,
+            }
+
+    def server_timing(self):
+        """Value of a Server-Timing header, which browsers show in their network panel"""
+        with self._lock:
+            return ", ".join(f"{stage};dur={entry['seconds'] * 1000:.1f}" for stage, entry in self.stages.items())
+
+
+# Timing of the request or job the current code runs for. asyncio tasks and `asyncio.to_thread` inherit it.
+current_timing = contextvars.ContextVar("current_timing", default=None)
+
+
+def run_in_threads(func, args, max_workers):
+    """`func(arg)` for every one of `args` on up to `max_workers` threads, returned in order.
+
+    Each call runs in a copy of the caller's context, so request-scoped state such as timings follows.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, func, arg) for arg in args]
+        return [future.result() for future in futures]
+
+
+@contextmanager
+def span(stage):
+    """Time a block as `stage`, in the stage histogram and in the current request's timing"""
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+
+def record_stage(stage, seconds):
+    """Record `seconds` spent in `stage`, for durations that don't fit a `span` block"""
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    timing = current_timing.get()
+    if timing is not None:
+        timing.add_stage(stage, seconds)
+
+
+def record_model_call(model, kind, usage=None, uploaded_bytes=0):
+    """Count one Gemini generate call of `kind` (e.g. "describe"), its tokens and the bytes sent with it"""
+    MODEL_CALLS.inc(model=model, kind=kind)
+    timing = current_timing.get()
+    if usage is not None:
+        input_tokens = usage.prompt_token_count or 0
+        output_tokens = (usage.total_token_count or 0) - input_tokens
+        MODEL_TOKENS.inc(input_tokens, model=model, direction="input")
+        MODEL_TOKENS.inc(output_tokens, model=model, direction="output")
+        if timing is not None:
+            timing.add("input_tokens", input_tokens)
+            timing.add("output_tokens", output_tokens)
+    if uploaded_bytes:
+        UPLOAD_BYTES.inc(uploaded_bytes, model=model)
+        if timing is not None:
+            timing.add("uploaded_bytes", uploaded_bytes)
+
+
+def record_download(size):
+    DOWNLOAD_BYTES.inc(size)
+    timing = current_timing.get()
+    if timing is not None:
+        timing.add("downloaded_bytes", size)
+
+
+def record_cache_lookup(cache, hit):
+    CACHE_LOOKUPS.inc(cache=cache, result="hit" if hit else "miss")
+
+
+def render():
+    """Every metric in the Prometheus text exposition format"""
+    lines = []
+    for metric in _METRICS:
+        lines.extend(metric.render())
+    # Hit ratio per cache, so dashboards don't need to compute it
+    lines += ["# HELP summarizer_cache_hit_ratio Share of cache lookups that were hits",
+              "# TYPE summarizer_cache_hit_ratio gauge"]
+    caches = sorted({dict(key)["cache"] for key in CACHE_LOOKUPS._values})
+    for cache in caches:
+        hits, misses = CACHE_LOOKUPS.value(cache=cache, result="hit"), CACHE_LOOKUPS.value(cache=cache, result="miss")
+        lines.append(f'summarizer_cache_hit_ratio{{cache="{cache}"}} {hits / (hits + misses) if hits + misses else 0}')
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,152 @@
+import asyncio
+import os
+
+
+class Stage:
+    """One step of the pipeline. `func` is an async callable applied to every item by `workers` workers.
+
+    If `ordered` is set, items are handed to this stage in the order the source produced them.
+    """
+
+    def __init__(self, name, func, workers=1, ordered=False):
+        self.name = name
+        self.func = func
+        self.workers = max(1, int(workers))
+        self.ordered = ordered
+
+
+def stage_workers(name, default):
+    """Worker count for a stage, overridable with e.g. DOWNLOAD_WORKERS=8"""
+    return int(os.environ.get(f"{name.upper()}_WORKERS", default))
+
+
+class SkipItem(Exception):
+    """Raised by a stage to drop one item without failing the run; another item takes its place"""
+
+
+_DONE = object()
+_FAILED = object()
+
+
+class _Admission:
+    """Keeps `completed + in_flight <= limit` and stops admitting new items after the first failure"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.completed = 0
+        self.error = None
+        self.condition = asyncio.Condition()
+
+    async def admit(self):
+        async with self.condition:
+            while True:
+                if self.error is not None:
+                    return False
+                if self.limit is None or self.completed + self.in_flight < self.limit:
+                    self.in_flight += 1
+                    return True
+                if self.completed >= self.limit:
+                    return False
+                await self.condition.wait()
+
+    async def finish(self, succeeded):
+        async with self.condition:
+            self.in_flight -= 1
+            if succeeded:
+                self.completed += 1
+            self.condition.notify_all()
+
+    async def fail(self, error):
+        async with self.condition:
+            if self.error is None:
+                self.error = error
+            self.condition.notify_all()
+
+
+async def _aiter(source):
+    for item in source:
+        yield item
+
+
+async def run_pipeline(source, stages, limit=None, queue_size=8):
+    """Run every item of `source` through `stages`, overlapping the stages with bounded queues between them.
+
+    At most `limit` items are run through the last stage successfully; the source is only pulled as long as
+    more items may still be needed. An item dropped with SkipItem frees its slot for the next one. After the
+    first other failure no new items are admitted, items already in flight are drained and the error is
+    raised. Returns the outputs of the last stage in source order.
+    """
+    queues = [asyncio.Queue(maxsize=queue_size) for _ in stages]
+    reorder = [{} for _ in stages]
+    next_seq = [0 for _ in stages]
+    reorder_locks = [asyncio.Lock() for _ in stages]
+    remaining_workers = [stage.workers for stage in stages]
+    admission = _Admission(limit)
+    results = {}
+
+    async def forward(index, seq, value):
+        if not stages[index].ordered:
+            await queues[index].put((seq, value))
+            return
+        reorder[index][seq] = value
+        async with reorder_locks[index]:
+            while next_seq[index] in reorder[index]:
+                ready = next_seq[index]
+                next_seq[index] += 1
+                await queues[index].put((ready, reorder[index].pop(ready)))
+
+    async def close(index):
+        for _ in range(stages[index].workers):
+            await queues[index].put(_DONE)
+
+    async def feed():
+        # Admit before pulling, so the source (and any page fetch behind it) is only advanced when needed
+        items = source.__aiter__() if hasattr(source, "__aiter__") else _aiter(source)
+        seq = 0
+        try:
+            while await admission.admit():
+                try:
+                    item = await items.__anext__()
+                except StopAsyncIteration:
+                    await admission.finish(False)
+                    break
+                await forward(0, seq, item)
+                seq += 1
+        except Exception as e:
+            await admission.finish(False)
+            await admission.fail(e)
+        finally:
+            if hasattr(items, "aclose"):
+                await items.aclose()
+            await close(0)
+
+    async def work(index):
+        stage = stages[index]
+        while True:
+            envelope = await queues[index].get()
+            if envelope is _DONE:
+                break
+            seq, value = envelope
+            if value is not _FAILED:
+                try:
+                    value = await stage.func(value)
+                except SkipItem:
+                    value = _FAILED
+                except Exception as e:
+                    await admission.fail(e)
+                    value = _FAILED
+            if index + 1 < len(stages):
+                await forward(index + 1, seq, value)
+            else:
+                if value is not _FAILED:
+                    results[seq] = value
+                await admission.finish(value is not _FAILED)
+        remaining_workers[index] -= 1
+        if remaining_workers[index] == 0 and index + 1 < len(stages):
+            await close(index + 1)
+
+    await asyncio.gather(feed(), *[work(index) for index, stage in enumerate(stages) for _ in range(stage.workers)])
+    if admission.error is not None:
+        raise admission.error
+    return [results[seq] for seq in sorted(results)]
@@ -0,0 +1,122 @@
+import glob
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+# none:      upload the original mp4
+# downscale: re-encode to at most PREPROCESS_HEIGHT pixels high at PREPROCESS_BITRATE
+# no_audio:  drop the audio track, the video stream is copied as is
+# frames:    one JPEG every PREPROCESS_FRAME_INTERVAL seconds, sent as an image sequence
+# keyframes: the JPEGs of the keyframes only, sent as an image sequence
+MODES = ("none", "downscale", "no_audio", "frames", "keyframes")
+IMAGE_MODES = ("frames", "keyframes")
+
+logger = logging.getLogger(__name__)
+
+
+class PreprocessResult:
+    """Files to send to Gemini instead of the original video, and how many bytes that saves"""
+
+    def __init__(self, mode, paths, original_bytes, seconds, workdir=None):
+        self.mode = mode
+        self.paths = paths
+        self.original_bytes = original_bytes
+        self.processed_bytes = sum(os.path.getsize(path) for path in paths)
+        self.seconds = seconds
+        self.workdir = workdir
+
+    @property
+    def saved_bytes(self):
+        return self.original_bytes - self.processed_bytes
+
+    def cleanup(self):
+        if self.workdir:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+_totals = {}
+_totals_lock = threading.Lock()
+
+
+def stats():
+    """Bytes in and out per mode since the process started"""
+    with _totals_lock:
+        return {mode: dict(totals, saved_bytes=totals["original_bytes"] - totals["processed_bytes"])
+                for mode, totals in _totals.items()}
+
+
+def ffmpeg_binary():
+    return shutil.which(os.environ.get("FFMPEG_BINARY", "ffmpeg"))
+
+
+def effective_mode(mode):
+    """The mode `preprocess_video` actually runs for `mode`, "none" when ffmpeg isn't installed"""
+    return mode if mode == "none" or ffmpeg_binary() is not None else "none"
+
+
+def cache_variant(mode):
+    """Summary cache variant of a mode that ran, so summaries of preprocessed videos are cached apart"""
+    return "" if mode == "none" else mode
+
+
+def _ffmpeg_args(mode, video_path, workdir):
+    height = int(os.environ.get("PREPROCESS_HEIGHT", 480))
+    scale = f"scale=-2:'min({height},ih)'"
+    max_frames = os.environ.get("PREPROCESS_MAX_FRAMES", "32")
+    if mode == "downscale":
+        bitrate = os.environ.get("PREPROCESS_BITRATE", "300k")
+        return ["-i", video_path, "-vf", scale, "-c:v", "libx264", "-preset", "veryfast", "-b:v", bitrate,
+                "-maxrate", bitrate, "-bufsize", bitrate, "-c:a", "aac", "-b:a", "48k",
+                os.path.join(workdir, "video.mp4")]
+    if mode == "no_audio":
+        return ["-i", video_path, "-an", "-c:v", "copy", os.path.join(workdir, "video.mp4")]
+    if mode == "frames":
+        interval = os.environ.get("PREPROCESS_FRAME_INTERVAL", "2")
+        return ["-i", video_path, "-vf", f"fps=1/{interval},{scale}", "-frames:v", max_frames, "-q:v", "5",
+                os.path.join(workdir, "frame_%04d.jpg")]
+    if mode == "keyframes":
+        # Non-keyframes are skipped by the decoder, so they are never even decoded
+        return ["-skip_frame", "nokey", "-i", video_path, "-vf", scale, "-fps_mode", "vfr",
+                "-frames:v", max_frames, "-q:v", "5", os.path.join(workdir, "frame_%04d.jpg")]
+    raise ValueError(f"Unknown preprocess mode: {mode}. Choose one of {', '.join(MODES)}")
+
+
+def preprocess_video(video_path, mode="none"):
+    """Shrink a video before it is sent to Gemini.
+
+    ffmpeg decodes the video as a stream, so memory stays bounded whatever the video length. Falls back to
+    the original file if ffmpeg isn't installed. Call `cleanup()` on the result once it was sent.
+    """
+    original_bytes = os.path.getsize(video_path)
+    if effective_mode(mode) != mode:
+        logger.warning("ffmpeg not found, sending %s without preprocessing", video_path)
+        mode = "none"
+    if mode == "none":
+        return PreprocessResult(mode, [video_path], original_bytes, 0.0)
+
+    start = time.monotonic()
+    workdir = tempfile.mkdtemp(prefix="preprocess-")
+    try:
+        subprocess.run([ffmpeg_binary(), "-hide_banner", "-loglevel", "error", "-y", *_ffmpeg_args(mode, video_path, workdir)],
+                       check=True, capture_output=True, timeout=600)
+        paths = sorted(glob.glob(os.path.join(workdir, "*")))
+        if not paths:
+            raise RuntimeError(f"ffmpeg produced no output for {video_path}")
+    except subprocess.CalledProcessError as e:
+        shutil.rmtree(workdir, ignore_errors=True)
+        raise RuntimeError(f"ffmpeg failed on {video_path}: {e.stderr.decode(errors='replace').strip()}")
+    except BaseException:
+        shutil.rmtree(workdir, ignore_errors=True)
+        raise
+    result = PreprocessResult(mode, paths, original_bytes, time.monotonic() - start, workdir=workdir)
+    with _totals_lock:
+        totals = _totals.setdefault(mode, {"videos": 0, "original_bytes": 0, "processed_bytes": 0, "seconds": 0.0})
+        totals["videos"] += 1
+        totals["original_bytes"] += result.original_bytes
+        totals["processed_bytes"] += result.processed_bytes
+        totals["seconds"] += result.seconds
+    return result
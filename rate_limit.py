@@ -0,0 +1,104 @@
+import os
+import random
+import threading
+import time
+
+import httpx
+from google.genai import errors
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled continuously at `per_minute` tokens per minute.
+
+    The level may go negative when more was used than reserved, which delays later callers instead of
+    letting the overshoot through.
+    """
+
+    def __init__(self, per_minute, capacity=None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount):
+        """Take `amount` tokens and return how long the caller has to wait before using them"""
+        with self._lock:
+            self._refill()
+            # A request larger than the bucket could never fit, let it through once the bucket is full
+            amount = min(amount, self.capacity)
+            self.level -= amount
+            return 0.0 if self.level >= 0 else -self.level / self.rate
+
+    def debit(self, amount):
+        with self._lock:
+            self._refill()
+            self.level -= amount
+
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute limits shared by every thread calling one model"""
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+
+    def acquire(self, tokens):
+        """Block until one request with an estimated `tokens` tokens may be sent"""
+        time.sleep(max(self.requests.reserve(1), self.tokens.reserve(tokens)))
+
+    def record(self, reserved, used):
+        """Account for the difference between the estimated and the reported token usage"""
+        if used and used > reserved:
+            self.tokens.debit(used - reserved)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def gemini_limiter(model):
+    """Process-wide limiter for `model`, configured with GEMINI_RPM and GEMINI_TPM"""
+    with _limiters_lock:
+        if model not in _limiters:
+            _limiters[model] = RateLimiter(int(os.environ.get("GEMINI_RPM", 2000)),
+                                           int(os.environ.get("GEMINI_TPM", 4000000)))
+        return _limiters[model]
+
+
+_tikapi_bucket = None
+
+
+def tikapi_limiter():
+    """Process-wide request bucket for TikAPI searches, configured with TIKAPI_RPM"""
+    global _tikapi_bucket
+    with _limiters_lock:
+        if _tikapi_bucket is None:
+            _tikapi_bucket = TokenBucket(int(os.environ.get("TIKAPI_RPM", 60)))
+        return _tikapi_bucket
+
+
+def is_retryable(error):
+    """Rate limiting, server side failures and dropped connections are worth another try"""
+    if isinstance(error, errors.APIError):
+        return error.code == 429 or error.code >= 500
+    return isinstance(error, (httpx.TransportError, ConnectionError, TimeoutError))
+
+
+def with_backoff(func, attempts=5, base_delay=1.0, max_delay=60.0, retry_on=is_retryable):
+    """Call `func` until it succeeds, sleeping with exponential backoff and full jitter in between.
+
+    Errors `retry_on` rejects, and the last error once `attempts` are used up, are raised.
+    """
+    for attempt in range(attempts):
+        try:
+            return func()
+        except Exception as e:
+            if attempt + 1 == attempts or not retry_on(e):
+                raise
+            time.sleep(random.uniform(0, min(max_delay, base_delay * 2 ** attempt)))
@@ -0,0 +1,323 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+from google.cloud import bigquery
+
+from metrics import span
+
+logger = logging.getLogger(__name__)
+
+# Keywords that are plain identifiers are used as table names as they are
+_TABLE_NAME = re.compile(r"[A-Za-z0-9_-]{1,1024}")
+
+
+def check_keyword(keyword):
+    """Return `keyword` if it is a usable search term, raise ValueError otherwise"""
+    if not isinstance(keyword, str) or not keyword.strip() or len(keyword) > 1024:
+        raise ValueError("Invalid keyword: it must be 1 to 1024 characters and not blank")
+    return keyword
+
+
+def table_name(keyword):
+    """BigQuery table name of `keyword`. Keywords with spaces or non-ASCII text become a slug of their
+    identifier characters plus a short hash, so every keyword gets its own valid table."""
+    if _TABLE_NAME.fullmatch(keyword):
+        return keyword
+    slug = re.sub(r"[^A-Za-z0-9_]+", "_", keyword).strip("_")[:64] or "keyword"
+    return f"{slug}_{hashlib.sha256(keyword.encode('utf-8')).hexdigest()[:10]}"
+
+
+class SummaryStore:
+    """Per-video summaries, one table per keyword.
+
+    Rows are dicts with `filename`, `summary` and `inserted_at` (seconds since the epoch). Backends
+    implement `ensure_table`, `write_rows` and `read_page`; reads are streamed page by page with
+    `iter_rows`, optionally only the rows inserted after `since`.
+    """
+
+    def ensure_table(self, keyword):
+        raise NotImplementedError
+
+    def write_rows(self, keyword, rows, row_ids=None):
+        """Insert a batch of rows. Returns a list of {"index", "errors"} for rows that were not stored,
+        like BigQuery's `insert_rows_json`. Rows written twice with the same row id are stored once."""
+        raise NotImplementedError
+
+    def read_page(self, keyword, page_size=1000, page_token=None, since=None):
+        """One page of rows in insertion order and the token of the next page, None after the last one"""
+        raise NotImplementedError
+
+    def iter_rows(self, keyword, since=None, page_size=1000):
+        page_token = None
+        while True:
+            rows, page_token = self.read_page(keyword, page_size, page_token, since)
+            yield from rows
+            if page_token is None:
+                return
+
+    def close(self):
+        pass
+
+
+class BigQueryStore(SummaryStore):
+    """Summaries in a BigQuery dataset, one table per keyword.
+
+    Unfiltered reads page through the table with `list_rows`, which neither starts a query job nor bills a
+    scan. Reads with `since` run one parameterized query and page through its result. `client` may be a
+    zero-argument callable, which is only called on first use.
+    """
+
+    def __init__(self, client, project_id=None, dataset_id=None):
+        self._client = client
+        self.project_id = project_id or os.environ["GCP_PROJECT_ID"]
+        self.dataset_id = dataset_id or os.environ["BQ_DATASET_ID"]
+
+    @property
+    def client(self):
+        if callable(self._client) and not hasattr(self._client, "insert_rows_json"):
+            self._client = self._client()
+        return self._client
+
+    def table_ref(self, keyword):
+        return f"{self.project_id}.{self.dataset_id}.{table_name(check_keyword(keyword))}"
+
+    def ensure_table(self, keyword):
+        schema = [
+            bigquery.SchemaField("filename", "STRING", mode="REQUIRED"),
+            bigquery.SchemaField("summary", "STRING", mode="NULLABLE"),
+            bigquery.SchemaField("inserted_at", "TIMESTAMP", mode="NULLABLE"),
+        ]
+        table = self.client.create_table(bigquery.Table(self.table_ref(keyword), schema=schema), exists_ok=True)
+        if "inserted_at" not in {field.name for field in table.schema}:
+            # Tables created before rows were timestamped
+            table.schema = list(table.schema) + [schema[-1]]
+            self.client.update_table(table, ["schema"])
+
+    def write_rows(self, keyword, rows, row_ids=None):
+        rows = [dict(row, inserted_at=_to_datetime(row.get("inserted_at") or time.time()).isoformat())
+                for row in rows]
+        return self.client.insert_rows_json(self.table_ref(keyword), rows, row_ids=row_ids)
+
+    def read_page(self, keyword, page_size=1000, page_token=None, since=None):
+        if page_token is not None:
+            source, page_token = json.loads(page_token)
+        elif since is None:
+            source = self.table_ref(keyword)
+        else:
+            job = self.client.query(
+                f"SELECT filename, summary, inserted_at FROM `{self.table_ref(keyword)}` "
+                "WHERE inserted_at > @since ORDER BY inserted_at",
+                job_config=bigquery.QueryJobConfig(query_parameters=[
+                    bigquery.ScalarQueryParameter("since", "TIMESTAMP", _to_datetime(since))
+                ]),
+                project=self.project_id
+            )
+            job.result()
+            # The anonymous result table, paged like any other table
+            destination = job.destination
+            source = f"{destination.project}.{destination.dataset_id}.{destination.table_id}"
+        iterator = self.client.list_rows(source, page_size=page_size, page_token=page_token)
+        page = next(iterator.pages, [])
+        rows = [{"filename": row["filename"], "summary": row["summary"],
+                 "inserted_at": row.get("inserted_at").timestamp() if row.get("inserted_at") else None}
+                for row in page]
+        next_token = json.dumps([source, iterator.next_page_token]) if iterator.next_page_token else None
+        return rows, next_token
+
+
+def _to_datetime(seconds):
+    return datetime.fromtimestamp(seconds, timezone.utc)
+
+
+class SQLiteStore(SummaryStore):
+    """Summaries in a local SQLite file, for development, tests and single-node deployments.
+
+    All keywords share one table indexed by keyword and insertion time, so reads never scan other
+    keywords' rows.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.environ.get("SUMMARY_STORE_PATH", ".cache/summary_store.sqlite")
+        self._lock = threading.Lock()
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS summaries ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, keyword TEXT NOT NULL, filename TEXT NOT NULL, summary TEXT, "
+            "inserted_at REAL NOT NULL, row_id TEXT UNIQUE)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS summaries_keyword_id ON summaries (keyword, id)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS summaries_keyword_inserted ON summaries (keyword, inserted_at)")
+        self._conn.commit()
+
+    def ensure_table(self, keyword):
+        check_keyword(keyword)
+
+    def write_rows(self, keyword, rows, row_ids=None):
+        check_keyword(keyword)
+        row_ids = row_ids or [uuid.uuid4().hex for _ in rows]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO summaries (keyword, filename, summary, inserted_at, row_id) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(keyword, row["filename"], row["summary"], row.get("inserted_at") or time.time(), row_id)
+                 for row, row_id in zip(rows, row_ids)]
+            )
+            self._conn.commit()
+        return []
+
+    def read_page(self, keyword, page_size=1000, page_token=None, since=None):
+        check_keyword(keyword)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, filename, summary, inserted_at FROM summaries "
+                "WHERE keyword = ? AND id > ? AND inserted_at > ? ORDER BY id LIMIT ?",
+                (keyword, int(page_token or 0), since if since is not None else float("-inf"), page_size)
+            ).fetchall()
+        next_token = str(rows[-1][0]) if len(rows) == page_size else None
+        return [{"filename": filename, "summary": summary, "inserted_at": inserted_at}
+                for _, filename, summary, inserted_at in rows], next_token
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def open_summary_store(bigquery_client=None):
+    """The store selected by SUMMARY_STORE: "bigquery" (default) or "sqlite" """
+    backend = os.environ.get("SUMMARY_STORE", "bigquery").lower()
+    if backend == "sqlite":
+        return SQLiteStore()
+    if backend == "bigquery":
+        return BigQueryStore(bigquery_client)
+    raise ValueError(f"Unknown SUMMARY_STORE {backend!r}, use 'bigquery' or 'sqlite'")
+
+
+class SummaryWriteError(Exception):
+    """Rows a `SummarySink` could not store, as (table_id, row) pairs in `rows`"""
+
+    def __init__(self, rows):
+        self.rows = rows
+        tables = ", ".join(sorted({table_id for table_id, _ in rows}))
+        super().__init__(f"Failed to store {len(rows)} summaries in {tables}")
+
+
+class SummarySink:
+    """Buffers summary rows per keyword and writes them to a `SummaryStore` in batches.
+
+    A keyword's buffer is flushed once it holds `max_rows` rows or `max_bytes` bytes of JSON, or when its
+    oldest row is `flush_interval` seconds old. Rows the store rejects are retried individually up to
+    `max_retries` times. Rows that still fail make `flush` and `close` raise SummaryWriteError, and are
+    sent again with the next flush of their keyword. `on_stored(table_id, rows)` is called with the rows of
+    every successful insert.
+    """
+
+    def __init__(self, store, max_rows=500, max_bytes=5 * 1024 * 1024, flush_interval=5.0, max_retries=3,
+                 retry_delay=0.5, on_stored=None):
+        self.store = store
+        self.on_stored = on_stored
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self._buffers = {}
+        self._failed = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._timer = None
+        if flush_interval:
+            self._timer = threading.Thread(target=self._flush_periodically, daemon=True)
+            self._timer.start()
+
+    def write(self, table_id, filename, summary, row_id=None):
+        """Buffer one row. A stable `row_id` lets the store drop the row when it is written again."""
+        # Timestamped now, so a retried row keeps its place in insertion order
+        row = {"filename": filename, "summary": summary, "inserted_at": time.time()}
+        size = len(json.dumps(row))
+        with self._lock:
+            buffer = self._buffers.setdefault(table_id, {"rows": [], "row_ids": [], "bytes": 0, "since": time.monotonic()})
+            if not buffer["rows"]:
+                buffer["since"] = time.monotonic()
+            buffer["rows"].append(row)
+            buffer["row_ids"].append(row_id or uuid.uuid4().hex)
+            buffer["bytes"] += size
+            full = len(buffer["rows"]) >= self.max_rows or buffer["bytes"] >= self.max_bytes
+        if full:
+            self.flush(table_id)
+
+    def flush(self, table_id=None):
+        """Send the buffered rows of `table_id` (or of every table) to the store, with the rows that failed
+        before. Raises SummaryWriteError if some of them could not be stored."""
+        with self._lock:
+            tables = [table_id] if table_id is not None else list(dict.fromkeys([*self._buffers, *self._failed]))
+            batches = []
+            for table in tables:
+                buffer = self._buffers.pop(table, None) or {"rows": [], "row_ids": []}
+                failed = self._failed.pop(table, [])
+                rows = [row for row, _ in failed] + buffer["rows"]
+                if rows:
+                    batches.append((table, rows, [row_id for _, row_id in failed] + buffer["row_ids"]))
+        lost = []
+        with self._flush_lock:
+            for table, rows, row_ids in batches:
+                failed = self._insert(table, rows, row_ids)
+                if failed:
+                    with self._lock:
+                        self._failed.setdefault(table, []).extend(failed)
+                    lost.extend((table, row) for row, _ in failed)
+        if lost:
+            raise SummaryWriteError(lost)
+
+    def _insert(self, table_id, rows, row_ids):
+        """Write `rows` with retries and return the (row, row_id) pairs that still failed"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                with span("store_write"):
+                    errors = self.store.write_rows(table_id, rows, row_ids=row_ids)
+            except Exception as e:
+                # The whole request failed, retry it as is. Row ids let the store de-duplicate a replay.
+                errors = [{"index": index, "errors": [str(e)]} for index in range(len(rows))]
+            failed = sorted({error["index"] for error in errors})
+            if self.on_stored is not None and len(failed) < len(rows):
+                stored = set(range(len(rows))) - set(failed)
+                self.on_stored(table_id, [rows[index] for index in sorted(stored)])
+            if not errors:
+                return []
+            if attempt == self.max_retries:
+                break
+            rows = [rows[index] for index in failed]
+            row_ids = [row_ids[index] for index in failed]
+            time.sleep(self.retry_delay * 2 ** attempt)
+        logger.error("Failed to insert %d rows into %s: %s", len(failed), table_id, errors)
+        return [(rows[index], row_ids[index]) for index in failed]
+
+    def _flush_periodically(self):
+        while not self._closed.wait(self.flush_interval / 2):
+            now = time.monotonic()
+            with self._lock:
+                due = [table for table, buffer in self._buffers.items()
+                       if buffer["rows"] and now - buffer["since"] >= self.flush_interval]
+            for table in due:
+                try:
+                    self.flush(table)
+                except SummaryWriteError:
+                    # Kept for the next flush of the keyword, whose caller gets the error then
+                    pass
+
+    def close(self):
+        """Stop the interval flusher and flush everything that is still buffered or failed before"""
+        self._closed.set()
+        if self._timer is not None:
+            self._timer.join()
+        self.flush()
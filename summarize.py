@@ -0,0 +1,283 @@
+import json
+import math
+import os
+import re
+import threading
+
+from metrics import run_in_threads
+
+
+# Input context of gemini-2.0-flash
+CONTEXT_TOKENS = 1048576
+
+
+class TokenEstimator:
+    """Local token counter for prompts, so no `count_tokens` round trip is needed.
+
+    Uses the SDK's local tokenizer when its optional `sentencepiece` dependency is installed. Otherwise
+    falls back to a characters-per-token ratio that starts conservative and is calibrated from the token
+    counts Gemini reports for the prompts that were actually sent.
+    """
+
+    def __init__(self, model=None, chars_per_token=4.0, safety=1.1):
+        self.chars_per_token = chars_per_token
+        self.safety = safety
+        self._lock = threading.Lock()
+        self._tokenizer = None
+        if model:
+            try:
+                from google.genai.local_tokenizer import LocalTokenizer
+                self._tokenizer = LocalTokenizer(model_name=model)
+            except Exception:
+                pass
+
+    def estimate(self, text):
+        if self._tokenizer is not None:
+            try:
+                return self._tokenizer.count_tokens(text).total_tokens
+            except Exception:
+                # e.g. the tokenizer model can't be downloaded, keep estimating from characters
+                self._tokenizer = None
+        return math.ceil(len(text) / self.chars_per_token * self.safety)
+
+    def calibrate(self, text, tokens):
+        if not text or not tokens:
+            return
+        with self._lock:
+            # Moving average, so one odd prompt doesn't swing the ratio
+            self.chars_per_token = 0.7 * self.chars_per_token + 0.3 * (len(text) / tokens)
+
+
+_estimators = {}
+_estimators_lock = threading.Lock()
+
+
+def token_estimator(model):
+    """Estimator shared by every call for `model`"""
+    with _estimators_lock:
+        if model not in _estimators:
+            _estimators[model] = TokenEstimator(model)
+        return _estimators[model]
+
+
+def pack_batches(texts, budget, estimate):
+    """Greedily group consecutive `texts` into batches whose estimated tokens stay within `budget`"""
+    batches, current, used = [], [], 0
+    for index, text in enumerate(texts):
+        tokens = estimate(text)
+        if current and used + tokens > budget:
+            batches.append(current)
+            current, used = [], 0
+        current.append(index)
+        used += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def format_indices(indices, total):
+    """Citation text for the 1-based `indices`, e.g. "(ALL)" or "(1, 3-5)" """
+    indices = sorted(set(indices))
+    if len(indices) == total:
+        return "(ALL)"
+    runs = []
+    for index in indices:
+        if runs and index == runs[-1][1] + 1:
+            runs[-1][1] = index
+        else:
+            runs.append([index, index])
+    return "(" + ", ".join(str(a) if a == b else f"{a}-{b}" for a, b in runs) + ")"
+
+
+_CITATION = re.compile(r"[(\[]\s*((?:ALL|\d+(?:\s*-\s*\d+)?)(?:\s*,\s*(?:ALL|\d+(?:\s*-\s*\d+)?))*)\s*[)\]]")
+
+
+def parse_citation(body):
+    """Yield the cited indices of a citation body such as "1, 3-5"; "ALL" is yielded as is"""
+    for part in body.split(","):
+        part = part.strip()
+        if part == "ALL":
+            yield part
+        elif "-" in part:
+            start, end = (int(value) for value in part.split("-"))
+            yield from range(start, end + 1)
+        else:
+            yield int(part)
+
+
+def split_citations(text, total):
+    """`text` without its citations, and the set of 1-based indices they cite; (ALL) cites 1 to `total`"""
+    cited = set()
+
+    def remove(match):
+        for index in parse_citation(match.group(1)):
+            cited.update(range(1, total + 1) if index == "ALL" else [index])
+        return ""
+
+    return re.sub(r"\s+([.!?,;:])", r"\1", _CITATION.sub(remove, text)).strip(), cited
+
+
+def remap_citations(text, index_map, total):
+    """Rewrite the citations in `text` from local to global numbering.
+
+    `index_map` maps every local 1-based index to the list of global indices it stands for; "(ALL)" stands
+    for every global index in the map. `total` is the number of global sources, so a citation covering all
+    of them is written back as "(ALL)". Citations with unknown indices are left untouched.
+    """
+    covered = sorted({index for indices in index_map.values() for index in indices})
+
+    def replace(match):
+        indices = []
+        for local in parse_citation(match.group(1)):
+            if local == "ALL":
+                indices.extend(covered)
+            elif local in index_map:
+                indices.extend(index_map[local])
+            else:
+                return match.group(0)
+        return format_indices(indices, total)
+
+    return _CITATION.sub(replace, text)
+
+
+def parse_summary_json(text):
+    """The summary dict from a model response, or None if it isn't valid JSON"""
+    text = text.strip().strip("`")
+    if text.startswith("json"):
+        text = text[len("json"):]
+    try:
+        result = json.loads(text)
+    except json.JSONDecodeError:
+        return None
+    return result if isinstance(result, dict) else None
+
+
+_FIELD_START = re.compile(r'"(\w+)"\s*:\s*"')
+
+
+def _decode_string(raw):
+    # A chunk may end inside an escape sequence, which is dropped until the rest of it arrives
+    for end in range(len(raw), max(-1, len(raw) - 6), -1):
+        try:
+            return json.loads('"' + raw[:end] + '"', strict=False)
+        except json.JSONDecodeError:
+            continue
+    return raw
+
+
+def partial_summary_fields(text):
+    """String fields of a summary JSON that is still being generated, as {name: (value so far, complete)}.
+
+    Fields are read in order up to the first one whose closing quote hasn't arrived yet.
+    """
+    fields = {}
+    position = 0
+    while True:
+        match = _FIELD_START.search(text, position)
+        if match is None:
+            return fields
+        end = match.end()
+        while end < len(text) and text[end] != '"':
+            end += 2 if text[end] == "\\" else 1
+        complete = end < len(text)
+        fields[match.group(1)] = (_decode_string(text[match.end():min(end, len(text))]), complete)
+        if not complete:
+            return fields
+        position = end + 1
+
+
+class _Partial:
+    """Intermediate summary together with the global source indices it covers"""
+
+    def __init__(self, text, covered):
+        self.text = text
+        self.covered = covered
+
+
+def _remap_partial(text, index_map, total):
+    result = parse_summary_json(text)
+    if result is None:
+        return remap_citations(text, index_map, total)
+    return json.dumps({key: remap_citations(value, index_map, total) if isinstance(value, str) else value
+                       for key, value in result.items()}, ensure_ascii=False)
+
+
+def tree_summarize(items, map_prompt, merge_prompt, generate, estimator, budget=None, max_workers=None,
+                   groups=None, final_generate=None):
+    """Summarize `items` with a hierarchical map-reduce and return (result, last prompt).
+
+    Without `groups` every item is one source. Otherwise `groups[i]` lists the 1-based sources item `i`
+    stands for (e.g. near-duplicates collapsed into one item), and citations of an item are expanded to
+    all of them. `map_prompt(numbered_items)` builds the prompt for one batch of items numbered from 1,
+    `merge_prompt(partials, is_final)` the prompt merging partial results, and `generate(prompt)` runs
+    one model call, and `final_generate(prompt)` the last one if it differs (e.g. streams its output).
+    Batches are packed by estimated tokens, map and merge calls of one level run
+    concurrently, and levels are reduced until a single merge fits the budget, so the number of
+    sequential calls grows logarithmically with the number of sources. Citations of every partial result
+    are rewritten to the global source numbering before it is merged. Raises ValueError without items.
+    """
+    if not items:
+        raise ValueError("Nothing to summarize: no items given")
+    budget = budget or int(os.environ.get("FINAL_SUMMARY_BATCH_TOKENS", CONTEXT_TOKENS // 2))
+    final_generate = final_generate or generate
+    max_workers = max_workers or int(os.environ.get("FINAL_SUMMARY_CONCURRENCY", 4))
+    groups = groups or [[index + 1] for index in range(len(items))]
+    total = sum(len(group) for group in groups)
+    overhead = estimator.estimate(map_prompt([]))
+    batches = pack_batches(items, max(1, budget - overhead), estimator.estimate)
+
+    if len(batches) == 1:
+        prompt = map_prompt(items)
+        text = final_generate(prompt)
+        if total != len(items):
+            text = _remap_partial(text, {local + 1: group for local, group in enumerate(groups)}, total)
+        return text, prompt
+
+    def summarize_batch(batch):
+        text = generate(map_prompt([items[index] for index in batch]))
+        index_map = {local + 1: groups[index] for local, index in enumerate(batch)}
+        return _Partial(_remap_partial(text, index_map, total), sorted(i for index in batch for i in groups[index]))
+
+    def merge_group(group):
+        text = generate(merge_prompt([partial.text for partial in group], False))
+        covered = sorted({index for partial in group for index in partial.covered})
+        # Merged sentences may be marked (ALL), which only covers this group's sources
+        index_map = {index: [index] for index in covered}
+        return _Partial(_remap_partial(text, index_map, total), covered)
+
+    partials = run_in_threads(summarize_batch, batches, max_workers)
+    while True:
+        merge_overhead = estimator.estimate(merge_prompt([], False))
+        merge_batches = pack_batches([partial.text for partial in partials], max(1, budget - merge_overhead),
+                                     estimator.estimate)
+        if len(merge_batches) == 1:
+            prompt = merge_prompt([partial.text for partial in partials], True)
+            return final_generate(prompt), prompt
+        # Every merge has to shrink the level, even if a single partial already fills the budget
+        if any(len(batch) == 1 for batch in merge_batches):
+            merge_batches = [list(range(start, min(start + 2, len(partials))))
+                             for start in range(0, len(partials), 2)]
+        partials = run_in_threads(
+            lambda group: merge_group(group) if len(group) > 1 else group[0],
+            [[partials[index] for index in batch] for batch in merge_batches],
+            max_workers
+        )
+
+
+def incremental_summarize(previous, previous_total, items, map_prompt, merge_prompt, generate, estimator,
+                          budget=None, max_workers=None, groups=None, final_generate=None):
+    """Fold new `items` into `previous`, the result over the first `previous_total` sources.
+
+    Only the new items are summarized, numbered after the previous sources, and the two results are merged
+    with one more call, so the cost grows with the new items rather than with everything summarized so far.
+    `groups` (numbering the new sources from 1) and `final_generate` are as in `tree_summarize`.
+    Returns (result, last prompt).
+    """
+    new_total = sum(len(group) for group in groups) if groups else len(items)
+    total = previous_total + new_total
+    delta, _ = tree_summarize(items, map_prompt, merge_prompt, generate, estimator, budget, max_workers, groups)
+    delta = _remap_partial(delta, {local: [previous_total + local] for local in range(1, new_total + 1)}, total)
+    # "(ALL)" in the previous result only covers the previous sources
+    previous = _remap_partial(previous, {index: [index] for index in range(1, previous_total + 1)}, total)
+    prompt = merge_prompt([previous, delta], True)
+    return (final_generate or generate)(prompt), prompt
@@ -0,0 +1,43 @@
+"""ClientRegistry's pooled Gemini connection, with a stand-in transport instead of the network"""
+import threading
+
+import httpx
+
+import clients
+from clients import ClientRegistry
+
+
+def test_gemini_calls_share_one_pooled_client(monkeypatch):
+    created = []
+
+    class CountedClient(httpx.Client):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            created.append(self)
+
+    monkeypatch.setattr(clients.httpx, "Client", CountedClient)
+    handled = []
+
+    def handler(request):
+        handled.append(request.url.path)
+        return httpx.Response(200, json={"candidates": [{"content": {"role": "model", "parts": [{"text": "ok"}]}}]})
+
+    transport = httpx.MockTransport(handler)
+    with ClientRegistry(gemini_key="key", gemini_transport=transport, pool_size=4) as registry:
+        texts = []
+
+        def call():
+            texts.append(registry.gemini.models.generate_content(model="gemini-2.0-flash", contents=["hi"]).text)
+
+        threads = [threading.Thread(target=call) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert texts == ["ok"] * 8
+        assert len(handled) == 8
+        # Every call went through the one keep-alive client the registry built, and so its one pool
+        assert created == [registry._clients["gemini_http"]]
+        assert created[0]._transport is transport
+    assert created[0].is_closed
@@ -0,0 +1,73 @@
+"""SummarySink against the in-memory BigQuery of the benchmarks"""
+import pytest
+
+from benchmarks.fakes import FakeBigQuery, Latency, Recorder
+from storage import BigQueryStore, SummarySink, SummaryWriteError
+
+
+class FlakyBigQuery(FakeBigQuery):
+    """Rejects the rows of every insert whose filename is in `rejected`, `failures` times per filename"""
+
+    def __init__(self, failures=1, rejected=()):
+        super().__init__(Latency(time_scale=0), Recorder())
+        self.failures = {filename: failures for filename in rejected}
+        self.calls = []
+
+    def insert_rows_json(self, table_ref, rows, row_ids=None):
+        self.calls.append([row["filename"] for row in rows])
+        errors = [{"index": index, "errors": ["rejected"]} for index, row in enumerate(rows)
+                  if self.failures.get(row["filename"], 0) > 0]
+        for error in errors:
+            self.failures[rows[error["index"]]["filename"]] -= 1
+        failed = {error["index"] for error in errors}
+        super().insert_rows_json(table_ref, [row for index, row in enumerate(rows) if index not in failed],
+                                 [row_id for index, row_id in enumerate(row_ids) if index not in failed])
+        return errors
+
+
+def make_sink(client, **kwargs):
+    stored = []
+    store = BigQueryStore(client, project_id="project", dataset_id="dataset")
+    sink = SummarySink(store, flush_interval=0, retry_delay=0,
+                       on_stored=lambda table_id, rows: stored.extend(row["filename"] for row in rows), **kwargs)
+    return store, sink, stored
+
+
+def test_full_buffer_is_flushed_in_one_insert():
+    client = FlakyBigQuery()
+    store, sink, stored = make_sink(client, max_rows=3)
+    for number in range(4):
+        sink.write("nba", f"nba/{number}.mp4", "summary")
+    assert client.calls == [["nba/0.mp4", "nba/1.mp4", "nba/2.mp4"]]
+    sink.close()
+    assert client.calls[1:] == [["nba/3.mp4"]]
+    assert [row["filename"] for row in store.iter_rows("nba")] == [f"nba/{number}.mp4" for number in range(4)]
+    assert stored == [f"nba/{number}.mp4" for number in range(4)]
+
+
+def test_rejected_rows_are_retried_alone():
+    client = FlakyBigQuery(failures=2, rejected={"nba/1.mp4"})
+    store, sink, stored = make_sink(client, max_retries=3)
+    for number in range(3):
+        sink.write("nba", f"nba/{number}.mp4", "summary")
+    sink.flush("nba")
+    assert client.calls == [["nba/0.mp4", "nba/1.mp4", "nba/2.mp4"], ["nba/1.mp4"], ["nba/1.mp4"]]
+    assert sorted(row["filename"] for row in store.iter_rows("nba")) == ["nba/0.mp4", "nba/1.mp4", "nba/2.mp4"]
+    assert stored == ["nba/0.mp4", "nba/2.mp4", "nba/1.mp4"]
+
+
+def test_rows_failing_every_retry_raise_and_are_sent_with_the_next_flush():
+    client = FlakyBigQuery(failures=2, rejected={"nba/1.mp4"})
+    store, sink, stored = make_sink(client, max_retries=1)
+    sink.write("nba", "nba/0.mp4", "summary")
+    sink.write("nba", "nba/1.mp4", "summary")
+    with pytest.raises(SummaryWriteError) as error:
+        sink.flush("nba")
+    assert [row["filename"] for _, row in error.value.rows] == ["nba/1.mp4"]
+    assert stored == ["nba/0.mp4"]
+
+    sink.write("nba", "nba/2.mp4", "summary")
+    sink.close()
+    assert client.calls[-1] == ["nba/1.mp4", "nba/2.mp4"]
+    assert sorted(row["filename"] for row in store.iter_rows("nba")) == ["nba/0.mp4", "nba/1.mp4", "nba/2.mp4"]
+    assert stored == ["nba/0.mp4", "nba/1.mp4", "nba/2.mp4"]
@@ -1,169 +1,388 @@
-from tikapi import TikAPI
+import logging
 import os
-from google import genai
-from google.cloud import bigquery
+from google.genai import types
 import time
+import asyncio
+from clients import default_registry
+from summarize import tree_summarize, incremental_summarize, token_estimator
+from rate_limit import gemini_limiter, tikapi_limiter, with_backoff
+from preprocess import preprocess_video, IMAGE_MODES
+from storage import BigQueryStore
+from dedup import cluster_near_duplicates
+from metrics import span, record_model_call, record_stage
 
+logger = logging.getLogger(__name__)
 
-def _count_item_number(item_list):
-    return sum([True if 'downloadAddr' in item['video'] or 'playAddr' in item['video'] else False
-                for item in item_list])
+DESCRIBE_MODEL = "gemini-2.0-flash"
+FINAL_SUMMARY_MODEL = "gemini-2.0-flash"
+# Bump whenever _final_summary_prompt or _merge_summary_prompt change, so cached final summaries are rebuilt
+FINAL_SUMMARY_PROMPT_VERSION = 2
+# Tokens reserved from the rate limit for one video before Gemini reports the real usage
+VIDEO_TOKENS_ESTIMATE = int(os.environ.get("GEMINI_VIDEO_TOKENS_ESTIMATE", 10000))
 
 
-def query_response_from_tikapi(keyword="NBA", video_number=100, query_upper_limit=10):
-    api = TikAPI(os.environ["TIKAPI_KEY"])
-    current_query, current_video = 0, 0
-    response_list = []
-    next_cursor = None
-    while current_query < query_upper_limit and current_video < video_number:
-        response = api.public.search(
-            category="videos",
-            query=keyword,
-            nextCursor=next_cursor
-        )
-        item_list = response.json()['item_list']
-        current_video += _count_item_number(item_list)
-        current_query += 1
-        next_cursor = response.json()['nextCursor']
-        response_list.append(response)
-    return response_list
+class SearchPage:
+    """One TikAPI search response, parsed once"""
 
+    def __init__(self, number, response, body):
+        self.number = number
+        self.response = response
+        self.body = body
 
-def download_video_from_response(response, directory="NBA"):
-    print(response.status_code)
-    if directory:
-        os.makedirs(directory, exist_ok=True)
-    paths = []
-    for item in response.json()['item_list']:
+    @property
+    def video_headers(self):
+        # Same headers TikAPI's save_video sends along with the video link
+        headers = {
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/110.0.0.0 Safari/537.36"
+        }
+        other = self.body.get("$other") or {}
+        if isinstance(other.get("videoLinkHeaders"), dict):
+            headers.update(other["videoLinkHeaders"])
+        return headers
+
+
+def iter_downloadable_items(body):
+    for item in body['item_list']:
         item = item['video']
         if 'playAddr' not in item and 'downloadAddr' not in item:
             # Not downloadable, skip
             continue
-        if 'downloadAddr' in item:
-            response.save_video(item['downloadAddr'], f"{directory}/{item['id']}.mp4")
-        elif 'playAddr' in item:
-            response.save_video(item['playAddr'], f"{directory}/{item['id']}.mp4")
-        paths.append(f"{directory}/{item['id']}.mp4")
-    return paths
+        yield item
+
+
+async def query_response_from_tikapi(keyword="NBA", video_number=100, query_upper_limit=10, api=None):
+    """Yield (page, item) for every downloadable video as soon as its search page arrives.
+
+    Pages keep coming as long as the consumer pulls and TikAPI has more, up to `query_upper_limit` searches;
+    the consumer decides when it has enough. While the items of one page are consumed, the next page is
+    already being fetched if the pages seen so far hold fewer than `video_number` items. Past that, a page
+    is only fetched once the consumer pulls beyond the items seen, e.g. because some of them were skipped.
+    """
+    api = api or default_registry().tikapi
+
+    def search(next_cursor):
+        # Searches of every keyword a process works on share one limit
+        time.sleep(tikapi_limiter().reserve(1))
+        with span("tikapi_search"):
+            response = api.public.search(
+                category="videos",
+                query=keyword,
+                nextCursor=next_cursor
+            )
+            return response, response.json()
+
+    current_query, current_video = 0, 0
+    pending = asyncio.create_task(asyncio.to_thread(search, None))
+    try:
+        while pending is not None:
+            response, body = await pending
+            current_query += 1
+            page = SearchPage(current_query, response, body)
+            pending = None
+            items = list(iter_downloadable_items(body))
+            current_video += len(items)
+            next_cursor = body.get('nextCursor')
+            has_more = bool(next_cursor) and body.get('hasMore', True) and current_query < query_upper_limit
+            if has_more and current_video < video_number:
+                pending = asyncio.create_task(asyncio.to_thread(search, next_cursor))
+            for item in items:
+                yield page, item
+            if has_more and pending is None:
+                # The consumer still pulls after the items seen, so some were skipped: the next page is needed
+                pending = asyncio.create_task(asyncio.to_thread(search, next_cursor))
+    finally:
+        if pending is not None:
+            pending.cancel()
+
+
+def download_video(page, item, directory="NBA", store=None):
+    """Download one video and return its local path.
+
+    With a VideoStore the video is streamed into the shared store and stays pinned until
+    `store.unpin(item['id'])`; otherwise it is saved to `directory` through TikAPI.
+    """
+    url = item['downloadAddr'] if 'downloadAddr' in item else item['playAddr']
+    with span("download"):
+        if store is not None:
+            return store.fetch(item['id'], url, headers=page.video_headers).path
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        path = f"{directory}/{item['id']}.mp4"
+        page.response.save_video(url, path)
+        return path
+
+
+def download_video_from_response(response, directory="NBA"):
+    logger.info("TikAPI responded with status %s", response.status_code)
+    page = SearchPage(1, response, response.json())
+    return [download_video(page, item, directory=directory) for item in iter_downloadable_items(page.body)]
 
             
-def describe_video(video_path, prompt, model="gemini-2.0-flash"):
-    client = genai.Client(api_key=os.environ["GEMINI_KEY"])
-    video_file = client.files.upload(file=video_path)
-    time.sleep(2)
-    for query_idx in range(3):
-        # Retry 3 times to wait finishing file uploading
-        try:
-            response = client.models.generate_content(
+def wait_until_active(client, video_file, timeout=300, poll_interval=0.5, max_poll_interval=5):
+    """Poll an uploaded file until Gemini has finished processing it"""
+    deadline = time.monotonic() + timeout
+    while video_file.state == types.FileState.PROCESSING:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"{video_file.name} is still processing after {timeout}s")
+        time.sleep(poll_interval)
+        poll_interval = min(poll_interval * 1.5, max_poll_interval)
+        video_file = with_backoff(lambda: client.files.get(name=video_file.name))
+    if video_file.state == types.FileState.FAILED:
+        raise RuntimeError(f"Gemini failed to process {video_file.name}: {video_file.error}")
+    return video_file
+
+
+def describe_video(video_path, prompt, model=DESCRIBE_MODEL, client=None, preprocess="none"):
+    """The description of a video and the preprocessing mode that actually ran, as (text, mode)"""
+    client = client or default_registry().gemini
+    limiter = gemini_limiter(model)
+    with span("preprocess"):
+        prepared = preprocess_video(video_path, preprocess)
+    if prepared.mode != "none":
+        logger.info("Preprocessed %s (%s): %d -> %d bytes in %.1fs", video_path, prepared.mode,
+                    prepared.original_bytes, prepared.processed_bytes, prepared.seconds)
+    uploaded = []
+    try:
+        if prepared.mode in IMAGE_MODES:
+            # The sampled frames are small enough to be sent inline, which also saves the upload round trips
+            contents = []
+            for frame_path in prepared.paths:
+                with open(frame_path, "rb") as frame:
+                    contents.append(types.Part.from_bytes(data=frame.read(), mime_type="image/jpeg"))
+            contents.append(f"The video is given as {len(prepared.paths)} frames in chronological order. " + prompt)
+        else:
+            with span("gemini_upload"):
+                video_file = with_backoff(lambda: client.files.upload(file=prepared.paths[0]))
+            uploaded.append(video_file)
+            with span("gemini_processing"):
+                contents = [wait_until_active(client, video_file), prompt]
+        estimated_tokens = VIDEO_TOKENS_ESTIMATE
+
+        def generate():
+            limiter.acquire(estimated_tokens)
+            return client.models.generate_content(
                 model=model,
-                contents=[video_file, prompt]
+                contents=contents
             )
-            break
-        except:
-            print(f"{query_idx+1} time failed to query Gemini, wait for 5 more secs.")
-            time.sleep(5)
-    return response.text
-
-
-def create_bigquery_table(table_id, project_id='glossy-reserve-450922-p9', dataset_id='video_summary'):
-    schema = [
-        {"name": "filename", "type": "STRING", "mode": "REQUIRED"},
-        {"name": "summary", "type": "STRING", "mode": "NULLABLE"}
-    ]
-    client = bigquery.Client()
-    table_ref = f"{project_id}.{dataset_id}.{table_id}"
-    table = bigquery.Table(table_ref, schema=schema)
-    client.create_table(table, exists_ok=True)
-
-
-def write_summary_to_bq(project_id, dataset_id, table_id, filename, summary):
-    client = bigquery.Client()
-    table_ref = f"{project_id}.{dataset_id}.{table_id}"
-
-    rows_to_insert = [
-        {"filename": filename, "summary": summary}
-    ]
-    client.insert_rows_json(table_ref, rows_to_insert)
-    
-    
-def grab_summaries_from_bq(project_id, dataset_id, table_id):
-    bq_client = bigquery.Client(project=project_id)
-    
-    query = f"""
-        SELECT summary
-        FROM `{project_id}.{dataset_id}.{table_id}`
+
+        with span("gemini_generate"):
+            response = with_backoff(generate)
+        record_model_call(model, "describe", response.usage_metadata, uploaded_bytes=prepared.processed_bytes)
+        if response.usage_metadata is not None:
+            limiter.record(estimated_tokens, response.usage_metadata.total_token_count)
+        return response.text, prepared.mode
+    finally:
+        # The upload is only needed for this one call
+        for video_file in uploaded:
+            try:
+                client.files.delete(name=video_file.name)
+            except Exception as e:
+                logger.warning("Failed to delete uploaded file %s: %s", video_file.name, e)
+        prepared.cleanup()
+
+
+def create_bigquery_table(table_id, project_id=None, dataset_id=None, client=None):
+    BigQueryStore(client or default_registry().bigquery, project_id, dataset_id).ensure_table(table_id)
+
+
+def write_summary_to_bq(project_id, dataset_id, table_id, filename, summary, client=None):
+    store = BigQueryStore(client or default_registry().bigquery, project_id, dataset_id)
+    store.write_rows(table_id, [{"filename": filename, "summary": summary}])
+
+
+def grab_summaries_from_bq(project_id, dataset_id, table_id, client=None):
+    store = BigQueryStore(client or default_registry().bigquery, project_id, dataset_id)
+    return [row['summary'] for row in store.iter_rows(table_id)]
+
+
+def _final_summary_prompt(summary_batch, table_id):
+    all_summary_batch = [f"{idx+1}. "+row.replace('#', '') for idx, row in enumerate(summary_batch)]
+    all_summary_batch_str = '\n-----------------\n'.join(all_summary_batch + [''])
+    # prompt_final_summary = ("All above are a series of descriptions from TikTok videos under keyword {}. "
+    #                         "Please generate a summary for those, generally about what's the hot topics people "
+    #                         "are discussing under {}. Please directly return the result, without any word like okay sure."
+    #                         "Also, please tell me the reference of each sentence you generated. To be specific, "
+    #                         "my prompt is splitted by line splitter. You can simply gives me the index of the reference "
+    #                         "based on those line splitters. Also please change the line for each sentence. If you feel"
+    #                         "this sentence is general, simply put (ALL) afterwards instead of numbers. ").format(table_id, table_id)
+    prompt_final_summary = ("You are an AI specialized in analyzing trending discussions from TikTok videos. Given multiple descriptions of videos under the keyword {}, your task is to:"
+                            "1. Generate a concise summary of the most discussed topics."
+                            "2. For each sentence in your summary, provide its reference index based on the original descriptions."
+                            "- The input descriptions are split by a line separator."
+                            "- If a sentence is general and applies to all input descriptions, mark it with (ALL)."
+                            "- Please put those reference after each sentence in summary. "
+                            "3. Explain why each reference was chosen or not chosen:"
+                            "- Justify why the selected references support the summary sentence."
+                            "- If some descriptions were excluded, explain why they were not relevant."
+                            "- Provide as much details as possible, and provide reasons for EACH video, if possible. "
+                            "4. Also please change the line for each sentence."
+                            "A description starting with [N near-identical videos] stands for N videos, weigh it accordingly. "
+                            "Return the result in the following JSON format: "
+                            "IMPORTANT: Please make sure the output is able to be parsed by json.loads. ").format(table_id)
+
+    prompt_final_summary += "{'summary': 'Your summaries in sentences. ', 'justification': 'Your justification contents. ', 'exclusion': 'Your exclusion contents. '}"
+    return all_summary_batch_str + prompt_final_summary
+
+
+def _merge_summary_prompt(partial_summaries, is_final):
+    summary_all = "\n------------\n".join(partial_summaries + [''])
+    prompt_all_summary = ("All above are the summaries of different batches of TikTok videos. Please merge them together in a reasonable way. "
+                          "Keep the reference index after each sentence exactly as given, and when sentences are merged, "
+                          "combine their references, e.g. (1, 3-5). Only mark a sentence with (ALL) if it is marked (ALL) "
+                          "or cites every reference in all of the summaries above. Merge the justification and exclusion "
+                          "contents the same way. "
+                          "Return the result in the same JSON format: "
+                          "IMPORTANT: Please make sure the output is able to be parsed by json.loads. ")
+    prompt_all_summary += "{'summary': 'Your summaries in sentences. ', 'justification': 'Your justification contents. ', 'exclusion': 'Your exclusion contents. '}"
+    return summary_all + prompt_all_summary
+
+
+def _final_summary_generate(model, client, on_text=None):
+    """generate(prompt) for final-summary calls. With `on_text`, the response is streamed and `on_text` gets
+    the text received so far after every chunk."""
+    estimator = token_estimator(model)
+    limiter = gemini_limiter(model)
+
+    def generate(prompt):
+        estimated_tokens = estimator.estimate(prompt)
+
+        def send():
+            # Send text to Gemini
+            limiter.acquire(estimated_tokens)
+            if on_text is None:
+                response = client.models.generate_content(
+                    model=model,
+                    contents=[prompt]
+                )
+                return response.text, response.usage_metadata
+            # A retry starts over, on_text then gets a shorter text than before
+            start = time.perf_counter()
+            text, usage = "", None
+            for chunk in client.models.generate_content_stream(model=model, contents=[prompt]):
+                if not text and chunk.text:
+                    record_stage("final_summary_first_chunk", time.perf_counter() - start)
+                text += chunk.text or ""
+                usage = chunk.usage_metadata or usage
+                on_text(text)
+            return text, usage
+
+        with span("final_summary_generate"):
+            text, usage = with_backoff(send)
+        record_model_call(model, "final_summary", usage)
+        if usage is not None:
+            estimator.calibrate(prompt, usage.prompt_token_count)
+            limiter.record(estimated_tokens, usage.total_token_count)
+        return text
+
+    return generate, estimator
+
+
+def collapse_duplicates(summary_ls):
+    """Near-duplicate summaries (reposts, re-uploads) merged into one weighted item each.
+
+    Returns the items to send and, for every item, the 1-based indices of the summaries it stands for.
     """
+    if os.environ.get("FINAL_SUMMARY_DEDUP", "1") == "0":
+        return list(summary_ls), None
+    with span("dedup"):
+        clusters = cluster_near_duplicates(summary_ls)
+    if len(clusters) == len(summary_ls):
+        return list(summary_ls), None
+    logger.info("Collapsed %d summaries into %d distinct ones", len(summary_ls), len(clusters))
+    items = [summary_ls[cluster[0]] if len(cluster) == 1
+             else f"[{len(cluster)} near-identical videos] {summary_ls[cluster[0]]}" for cluster in clusters]
+    return items, [[index + 1 for index in cluster] for cluster in clusters]
 
-    query_job = bq_client.query(query)
-    results = query_job.result()
 
-    # Concatenate all summary together
-    # summary_ls = [f'{idx+1}. ' + row['summary'] for idx, row in enumerate(results)]
-    summary_ls = [row['summary'] for idx, row in enumerate(results)]
-    return summary_ls
-    
+def final_summary(summary_ls, table_id, model=FINAL_SUMMARY_MODEL, client=None, on_text=None):
+    """Summarize `summary_ls` and return (result, prompt). With `on_text`, the last call is streamed to it."""
+    client = client or default_registry().gemini
+    # Tokens are estimated locally to split the input into batches that fit the context window
+    generate, estimator = _final_summary_generate(model, client)
+    final_generate = _final_summary_generate(model, client, on_text)[0] if on_text else None
+    items, groups = collapse_duplicates(summary_ls)
+    return tree_summarize(
+        items,
+        map_prompt=lambda summary_batch: _final_summary_prompt(summary_batch, table_id),
+        merge_prompt=_merge_summary_prompt,
+        generate=generate,
+        estimator=estimator,
+        groups=groups,
+        final_generate=final_generate
+    )
 
 
-def final_summary(summary_ls, table_id, model="gemini-2.0-flash"):
-    # Calculate tokens first to avoid exceeding upper limit
-    client = genai.Client(api_key=os.environ["GEMINI_KEY"])
-    summary_str = "\n------------\n".join(summary_ls+[''])
-    response = client.models.count_tokens(
-        model=model,
-        contents=[summary_str],
+def update_final_summary(previous_result, previous_count, new_summaries, table_id, model=FINAL_SUMMARY_MODEL,
+                         client=None, on_text=None):
+    """Merge `new_summaries` into a final summary of `previous_count` summaries. New summaries are cited
+    as previous_count + 1 onwards. `on_text` is as in `final_summary`."""
+    client = client or default_registry().gemini
+    generate, estimator = _final_summary_generate(model, client)
+    final_generate = _final_summary_generate(model, client, on_text)[0] if on_text else None
+    items, groups = collapse_duplicates(new_summaries)
+    return incremental_summarize(
+        previous_result,
+        previous_count,
+        items,
+        map_prompt=lambda summary_batch: _final_summary_prompt(summary_batch, table_id),
+        merge_prompt=_merge_summary_prompt,
+        generate=generate,
+        estimator=estimator,
+        groups=groups,
+        final_generate=final_generate
     )
-    token_number = response.total_tokens
-    
-    batch_num = token_number // 1048576 + 1
-    batch_size = max(1, int(len(summary_ls)//batch_num))
-    
-    final_summary_ls = []
-    
-    # Batch Processing each input
-    for batch_id in range(batch_num):
-        all_summary_batch = [f"{idx+1}. "+row.replace('#', '') for idx, row in enumerate(summary_ls[(batch_id*batch_size):(batch_id+1)*batch_size])]
-        all_summary_batch_str = '\n-----------------\n'.join(all_summary_batch + [''])
-        # Query GEMINI
-        # prompt_final_summary = ("All above are a series of descriptions from TikTok videos under keyword {}. "
-        #                         "Please generate a summary for those, generally about what's the hot topics people "
-        #                         "are discussing under {}. Please directly return the result, without any word like okay sure."
-        #                         "Also, please tell me the reference of each sentence you generated. To be specific, "
-        #                         "my prompt is splitted by line splitter. You can simply gives me the index of the reference "
-        #                         "based on those line splitters. Also please change the line for each sentence. If you feel"
-        #                         "this sentence is general, simply put (ALL) afterwards instead of numbers. ").format(table_id, table_id)
-        prompt_final_summary = ("You are an AI specialized in analyzing trending discussions from TikTok videos. Given multiple descriptions of videos under the keyword {}, your task is to:"
-                                "1. Generate a concise summary of the most discussed topics."
-                                "2. For each sentence in your summary, provide its reference index based on the original descriptions."
-                                "- The input descriptions are split by a line separator."
-                                "- If a sentence is general and applies to all input descriptions, mark it with (ALL)."
-                                "- Please put those reference after each sentence in summary. "
-                                "3. Explain why each reference was chosen or not chosen:"
-                                "- Justify why the selected references support the summary sentence."
-                                "- If some descriptions were excluded, explain why they were not relevant."
-                                "- Provide as much details as possible, and provide reasons for EACH video, if possible. "
-                                "4. Also please change the line for each sentence."
-                                "Return the result in the following JSON format: "
-                                "IMPORTANT: Please make sure the output is able to be parsed by json.loads. ").format(table_id)
-                                
-        prompt_final_summary += "{'summary': 'Your summaries in sentences. ', 'justification': 'Your justification contents. ', 'exclusion': 'Your exclusion contents. '}"
-        prompt = all_summary_batch_str + prompt_final_summary
-
-        # Send text to Gemini
-        response = client.models.generate_content(
-            model=model,
-            contents=[prompt]
-        )
-        final_summary_ls.append(response.text)
-        
-    if batch_num == 1:
-        return final_summary_ls[0], prompt
+
+
+def _needs_rebuild(state, rows):
+    if state is None or os.environ.get("FINAL_SUMMARY_INCREMENTAL", "1") == "0":
+        return True
+    # Rows that were covered have been deleted or rewritten, the indices of the stored result are stale
+    if any(rows.get(filename) != summary for filename, summary in zip(state["filenames"], state["summaries"])):
+        return True
+    # Merging deltas over and over slowly drifts from what a summary of everything would say
+    if state["updates"] >= int(os.environ.get("FINAL_SUMMARY_REBUILD_EVERY", 10)):
+        return True
+    return time.time() - state["rebuilt_at"] > float(os.environ.get("FINAL_SUMMARY_REBUILD_SECONDS", 7 * 24 * 3600))
+
+
+def cached_final_summary(rows, table_id, cache, model=FINAL_SUMMARY_MODEL, client=None, on_text=None):
+    """Final summary of the (filename, summary) `rows` of a keyword, reusing earlier work in `cache`.
+
+    An unchanged set of summaries is served from the cache. When rows were only added since the last
+    result, just the new ones are summarized and merged into it; a full rebuild runs when there is no
+    previous result, covered rows changed, or after too many incremental updates. Summaries keep their
+    position across updates and new ones are appended, so the indices of earlier results stay valid.
+    `on_text` gets the streamed text of the last model call, if there is one.
+    Returns (result, summaries in cited order, prompt).
+    """
+    rows = dict(rows)  # One summary per video, even if it was stored more than once
+    state = cache.get_state(table_id, model, FINAL_SUMMARY_PROMPT_VERSION)
+    incremental = not _needs_rebuild(state, rows)
+    if incremental:
+        covered = set(state["filenames"])
+        filenames = state["filenames"] + [filename for filename in rows if filename not in covered]
+    else:
+        filenames = list(rows)
+    summaries = [rows[filename] for filename in filenames]
+
+    cached = cache.get(table_id, model, FINAL_SUMMARY_PROMPT_VERSION, summaries)
+    if cached is not None:
+        return cached["result"], cached["summaries"], cached["prompt"]
+
+    if incremental and len(filenames) == len(state["filenames"]):
+        # Nothing new, the cache entry was only evicted
+        result, prompt, rebuilt_at, updates = state["result"], state["prompt"], state["rebuilt_at"], state["updates"]
+    elif incremental:
+        new_summaries = summaries[len(state["filenames"]):]
+        result, prompt = update_final_summary(state["result"], len(state["filenames"]), new_summaries, table_id,
+                                              model=model, client=client, on_text=on_text)
+        rebuilt_at, updates = state["rebuilt_at"], state["updates"] + 1
     else:
-        final_summary_ls = final_summary_ls + ['']
-        summary_all = "\n------------\n".join(final_summary_ls)
-        prompt_all_summary = ("All above are the summaries of different batches of TikTok videos. Please merge them together in a reasonable way. ")
-        prompt = summary_all + prompt_all_summary
-        response = client.models.generate_content(
-            model=model,
-            contents=[prompt]
-        )
-        return response.text, prompt
\ No newline at end of file
+        result, prompt = final_summary(summaries, table_id=table_id, model=model, client=client, on_text=on_text)
+        rebuilt_at, updates = time.time(), 0
+    cache.put(table_id, model, FINAL_SUMMARY_PROMPT_VERSION, summaries, result, prompt)
+    cache.put_state(table_id, model, FINAL_SUMMARY_PROMPT_VERSION, {
+        "filenames": filenames, "summaries": summaries, "result": result, "prompt": prompt,
+        "rebuilt_at": rebuilt_at, "updates": updates,
+    })
+    return result, summaries, prompt
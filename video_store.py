@@ -0,0 +1,153 @@
+import os
+import tempfile
+import threading
+import time
+from collections import Counter, OrderedDict
+
+import requests
+
+from metrics import record_cache_lookup, record_download
+
+
+class VideoTooLargeError(Exception):
+    pass
+
+
+class DownloadResult:
+    def __init__(self, path, size, seconds, cached):
+        self.path = path
+        self.size = size
+        self.seconds = seconds
+        self.cached = cached
+
+
+class VideoStore:
+    """Local mp4 store shared by every keyword, bounded in size.
+
+    Videos are stored once per TikTok video id, streamed to a temporary file and moved into place only when
+    complete, so a partial download is never picked up. Files above `max_file_bytes` are rejected while
+    streaming. Once the store holds more than `max_total_bytes`, the least recently used videos are deleted,
+    except those pinned because an upload to Gemini is still reading them.
+    """
+
+    def __init__(self, root=None, max_file_bytes=None, max_total_bytes=None, session=None, chunk_size=1024 * 1024):
+        self.root = root or os.environ.get("VIDEO_STORE_PATH", ".cache/videos")
+        self.max_file_bytes = int(max_file_bytes or float(os.environ.get("VIDEO_MAX_FILE_MB", 200)) * 1024 * 1024)
+        self.max_total_bytes = int(max_total_bytes or float(os.environ.get("VIDEO_STORE_MAX_MB", 5000)) * 1024 * 1024)
+        self.session = session or requests.Session()
+        self.chunk_size = chunk_size
+        self.total_bytes = 0
+        self.downloads = 0
+        self.downloaded_bytes = 0
+        self.download_seconds = 0.0
+        self.hits = 0
+        self.evictions = 0
+        self._files = OrderedDict()
+        self._pins = Counter()
+        self._downloading = {}
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+        # Pick up what an earlier process left behind, oldest access first
+        existing = [entry for entry in os.scandir(self.root) if entry.name.endswith(".mp4")]
+        for entry in sorted(existing, key=lambda entry: entry.stat().st_atime):
+            self._files[entry.name[:-len(".mp4")]] = entry.stat().st_size
+            self.total_bytes += entry.stat().st_size
+
+    def path(self, video_id):
+        return os.path.join(self.root, f"{video_id}.mp4")
+
+    def fetch(self, video_id, url, headers=None, pin=True):
+        """Return the local copy of a video, downloading it unless it is already stored.
+
+        With `pin`, the file is protected from eviction until `unpin(video_id)` is called.
+        """
+        while True:
+            with self._lock:
+                if video_id in self._files:
+                    self._files.move_to_end(video_id)
+                    if pin:
+                        self._pins[video_id] += 1
+                    self.hits += 1
+                    record_cache_lookup("videos", True)
+                    return DownloadResult(self.path(video_id), self._files[video_id], 0.0, True)
+                pending = self._downloading.get(video_id)
+                if pending is None:
+                    pending = self._downloading[video_id] = threading.Event()
+                    break
+            # The same video is being downloaded for another keyword, wait and reuse it
+            pending.wait()
+
+        try:
+            record_cache_lookup("videos", False)
+            start = time.monotonic()
+            size = self._download(url, headers, self.path(video_id))
+            seconds = time.monotonic() - start
+            record_download(size)
+            with self._lock:
+                self._files[video_id] = size
+                self.total_bytes += size
+                if pin:
+                    self._pins[video_id] += 1
+                self.downloads += 1
+                self.downloaded_bytes += size
+                self.download_seconds += seconds
+                self._evict()
+            return DownloadResult(self.path(video_id), size, seconds, False)
+        finally:
+            with self._lock:
+                self._downloading.pop(video_id).set()
+
+    def _download(self, url, headers, path):
+        with self.session.get(url, headers=headers, stream=True, timeout=60) as response:
+            response.raise_for_status()
+            if int(response.headers.get("Content-Length") or 0) > self.max_file_bytes:
+                raise VideoTooLargeError(f"{response.headers['Content-Length']} bytes exceeds the "
+                                         f"{self.max_file_bytes} bytes limit")
+            fd, temp_path = tempfile.mkstemp(dir=self.root, suffix=".part")
+            try:
+                size = 0
+                with os.fdopen(fd, "wb") as video_file:
+                    for chunk in response.iter_content(chunk_size=self.chunk_size):
+                        size += len(chunk)
+                        if size > self.max_file_bytes:
+                            raise VideoTooLargeError(f"more than {self.max_file_bytes} bytes")
+                        video_file.write(chunk)
+                os.replace(temp_path, path)
+            except BaseException:
+                os.remove(temp_path)
+                raise
+        return size
+
+    def unpin(self, video_id):
+        with self._lock:
+            self._pins[video_id] -= 1
+            if self._pins[video_id] <= 0:
+                del self._pins[video_id]
+            self._evict()
+
+    def _evict(self):
+        for video_id in list(self._files):
+            if self.total_bytes <= self.max_total_bytes:
+                break
+            if self._pins[video_id] > 0:
+                continue
+            size = self._files.pop(video_id)
+            self.total_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self.path(video_id))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                "videos": len(self._files),
+                "bytes": self.total_bytes,
+                "pinned": len(self._pins),
+                "hits": self.hits,
+                "downloads": self.downloads,
+                "downloaded_bytes": self.downloaded_bytes,
+                "download_seconds": round(self.download_seconds, 3),
+                "evictions": self.evictions,
+            }